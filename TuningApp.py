@@ -1,27 +1,68 @@
 #!/usr/bin/python3
+import argparse
+import json
 import os
 import os.path
-import shutil
+import subprocess
 import sys
+import threading
+import time
+import traceback
 import warnings
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-import cv2
 import numpy as np
-from picamera2 import Picamera2, Platform
-from picamera2.previews.qt import QGlPicamera2
-from PyQt5.QtCore import QTimer, pyqtSignal
+from PyQt5.QtCore import QObject, QProcess, Qt, QTimer, pyqtSignal
 from PyQt5.QtWidgets import (QApplication, QHBoxLayout, QLabel, QLineEdit,
                              QListWidget, QListWidgetItem, QMainWindow,
-                             QMessageBox, QPushButton, QTabWidget, QVBoxLayout,
-                             QWidget)
-
-# finding ctt folder
-ctt_directory = os.path.join(os.path.expanduser("~"), 'libcamera/utils/raspberrypi/ctt')
-sys.path.insert(1, ctt_directory)
-from ctt import Camera, run_ctt
-from ctt_image_load import dng_load_image
-from ctt_macbeth_locator import find_macbeth, get_macbeth_chart
+                             QMessageBox, QProgressDialog, QPushButton,
+                             QTabWidget, QVBoxLayout, QWidget)
+
+import session_manifest
+import timeline
+from capture_checks import (cac_check, cac_check_width, cac_problem,
+                            capture_kind, find_dot_grid, min_cac_sharpness,
+                            quick_check_file, quick_check_memory)
+from ctt_worker import ctt_directory
+from raw_burst import BurstSum
+
+# when the app was started, to measure how long start up takes
+start_time = time.monotonic()
+
+# where the sensor mode chosen for each camera model is remembered
+cache_directory = os.path.join(os.path.expanduser("~"), ".cache", "camera-tuning-app")
+
+# The camera, ctt and OpenCV are slow to start, so nothing here touches them at
+# import. load_camera() sets all of these in the background while FirstWindow is up.
+picam2 = None
+# which camera this process tunes, and how many there are. Each camera is tuned
+# by a process of its own, see tune_all_cameras().
+camera_num = 0
+camera_count = 1
+camera_model = None
+# the configuration the preview runs in, which every still switches back to
+preview_config = None
+target = None
+json_template = None
+# the lens shading grid of the ctt target, (columns, rows)
+grid_size = None
+ref_data = None
+cv2 = None
+Camera = dng_load_image = find_macbeth = get_macbeth_chart = None
+folder_directory = None
+# An earlier session folder to replay instead of using the camera, see replay_camera.py.
+# Several folders, separated by os.pathsep, are replayed as that many cameras.
+replay_folder = os.environ.get("TUNING_REPLAY")
+
+# prints how long it took to get to a point in start up, the first time only
+startup_times = {}
+
+
+def startup_time(name):
+    if name not in startup_times:
+        startup_times[name] = time.monotonic() - start_time
+        print("Time to " + name + ": %.2f s" % startup_times[name])
 
 
 # doesnt let runtime warning print
@@ -39,83 +80,336 @@ def sortBitDepth(d):
     return d['bit_depth']
 
 
-picam2 = Picamera2()
-candidate_modes = []
-
-
-for mode in picam2.sensor_modes:
-    if mode['crop_limits'].count(0) > 1:
-        candidate_modes.append(mode)
+# Chooses the sensor mode. Listing the sensor modes means configuring the camera
+# in every one of them, so the choice is remembered for each camera model.
+def choose_sensor_mode(picam2, model):
+    cache_file = os.path.join(cache_directory, model + ".json")
+    try:
+        with open(cache_file) as f:
+            sensor = json.load(f)
+        return {'output_size': tuple(sensor['output_size']), 'bit_depth': sensor['bit_depth']}
+    except (OSError, ValueError, KeyError):
+        pass
+
+    candidate_modes = []
+    for mode in picam2.sensor_modes:
+        if mode['crop_limits'].count(0) > 1:
+            candidate_modes.append(mode)
+
+    if len(candidate_modes) == 1:
+        mode = candidate_modes[0]
+    else:
+        candidate_modes.sort(key=sortModeArea)
+        tuple_ful = candidate_modes[-1]['size']
+        tuple_half = tuple(ti / 2 for ti in tuple_ful)
 
+        half_candidates = [mode for mode in candidate_modes if mode['size'] == tuple_half]
+        full_candidates = [mode for mode in candidate_modes if mode['size'] == tuple_ful]
 
-if len(candidate_modes) == 1:
-    mode = candidate_modes[0]
-else:
-    candidate_modes.sort(key=sortModeArea)
-    tuple_ful = candidate_modes[-1]['size']
-    tuple_half = tuple(ti / 2 for ti in tuple_ful)
+        if half_candidates:
+            half_candidates.sort(key=sortBitDepth)
+            mode = half_candidates[-1]
+        else:
+            full_candidates.sort(key=sortBitDepth)
+            mode = full_candidates[-1]
+    sensor = {'output_size': tuple(mode['size']), 'bit_depth': mode['bit_depth']}
+    os.makedirs(cache_directory, exist_ok=True)
+    # another camera of the same model may be choosing at the same time
+    tmp = cache_file + "." + str(os.getpid()) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(sensor, f)
+    os.replace(tmp, cache_file)
+    return sensor
 
-    half_candidates = [mode for mode in candidate_modes if mode['size'] == tuple_half]
-    full_candidates = [mode for mode in candidate_modes if mode['size'] == tuple_ful]
 
-    if half_candidates:
-        half_candidates.sort(key=sortBitDepth)
-        mode = half_candidates[-1]
-    else:
-        full_candidates.sort(key=sortBitDepth)
-        mode = full_candidates[-1]
 main = {"size": (800, 600)}
-sensor = {'output_size': mode['size'], 'bit_depth': mode['bit_depth']}
-config = picam2.create_preview_configuration(main=main, sensor=sensor)
-picam2.configure(config)
-
+# The chart is searched for on the Y plane of this small YUV stream, which needs
+# no colour conversion. Set it to None to search the main stream instead.
+lores_size = (640, 480)
+lores = {"size": lores_size, "format": "YUV420"} if lores_size else None
+detect_stream = "lores" if lores_size else "main"
+
+
+# The session folders of cameras tuned side by side are told apart by camera number
+def session_name(model):
+    return model if camera_count == 1 else model + "_cam" + str(camera_num)
+
+
+# Opens and configures the camera, then does the heavy imports. folder_found is
+# called with the suggested session folder as soon as the camera model is known.
+def load_camera(folder_found):
+    global picam2, target, camera_count, camera_model, preview_config
+    if replay_folder:
+        from replay_camera import ReplayCamera
+        folders = replay_folder.split(os.pathsep)
+        camera_count = len(folders)
+        picam2 = ReplayCamera(os.path.expanduser(folders[camera_num]))
+        camera_model = picam2.model
+        folder_found(default_folder(session_name(picam2.model)))
+        picam2.configure(picam2.create_preview_configuration(main=main, lores=lores))
+        target = picam2.target
+        load_ctt()
+        startup_time("camera and ctt ready")
+        return
+    from picamera2 import Picamera2, Platform
+    cameras = Picamera2.global_camera_info()
+    camera_count = len(cameras)
+    model = camera_model = cameras[camera_num]["Model"]
+    folder_found(default_folder(session_name(model)))
+
+    picam2 = Picamera2(camera_num)
+    sensor = choose_sensor_mode(picam2, model)
+    try:
+        picam2.configure(picam2.create_preview_configuration(main=main, lores=lores, sensor=sensor))
+    except Exception:
+        # the remembered mode is no good any more, choose again
+        os.remove(os.path.join(cache_directory, model + ".json"))
+        sensor = choose_sensor_mode(picam2, model)
+        picam2.configure(picam2.create_preview_configuration(main=main, lores=lores, sensor=sensor))
+    preview_config = picam2.camera_config
+
+    # what pi are we working on?
+    target = "pi5" if Picamera2.platform == Platform.PISP else "pi4"
+    load_ctt()
+    startup_time("camera and ctt ready")
+
+
+# imports ctt and OpenCV and loads the macbeth reference data
+def load_ctt():
+    global cv2, Camera, dng_load_image, find_macbeth, get_macbeth_chart, json_template, grid_size, ref_data
+    import cv2
+    sys.path.insert(1, ctt_directory)
+    from ctt import Camera
+    from ctt_image_load import dng_load_image
+    from ctt_macbeth_locator import find_macbeth, get_macbeth_chart
+    if target == "pi5":
+        from ctt_pisp import grid_size, json_template
+    else:
+        from ctt_vc4 import grid_size, json_template
 
-# Function that returns true if it can detect macbeth plot
-def check(filename, target):
-    Cam = Camera("imx.json", json=json_template)
-    Img = dng_load_image(Cam, filename)
+    # macbeth reference data
+    Cam = Camera("dummy_name.json", json=json_template)
+    s = os.path.join(Cam.path, 'ctt_ref.pgm')
+    ref = cv2.imread(s, flags=cv2.IMREAD_GRAYSCALE)
+    ref_data = (ref, ref_w, ref_h, ref_corns)
+
+
+# Unpacks a row of CSI2 packed pixels, (height, stride) bytes, into a uint16 image
+def unpack_csi2p(array, width, bit_depth):
+    if bit_depth == 10:
+        b = array[:, :width * 5 // 4].reshape(array.shape[0], -1, 5).astype(np.uint16)
+        pixels = (b[:, :, :4] << 2) | ((b[:, :, 4:] >> np.array([0, 2, 4, 6], dtype=np.uint16)) & 3)
+    elif bit_depth == 12:
+        b = array[:, :width * 3 // 2].reshape(array.shape[0], -1, 3).astype(np.uint16)
+        pixels = np.stack(((b[:, :, 0] << 4) | (b[:, :, 2] & 15), (b[:, :, 1] << 4) | (b[:, :, 2] >> 4)), axis=-1)
+    else:
+        raise ValueError("Unsupported packed bit depth " + str(bit_depth))
+    return pixels.reshape(array.shape[0], -1)[:, :width]
+
+
+# Turns a raw buffer of shape (height, stride) into a 2d image and its bit depth.
+# Unpacked formats are only viewed, packed and compressed ones have to be unpacked.
+def raw_image(array, config):
+    from picamera2 import SensorFormat
+    fmt = SensorFormat(config["format"])
+    w = config["size"][0]
+    if fmt.packing == "PISP_COMP1":
+        return picam2.helpers.decompress(array).view(np.uint16)[:, :w], 16
+    elif fmt.packing == "CSI2P":
+        return unpack_csi2p(array, w, fmt.bit_depth), fmt.bit_depth
+    elif fmt.bit_depth == 8:
+        return array[:, :w], 8
+    return array.view(np.uint16)[:, :w], fmt.bit_depth
+
+
+# The average of the four Bayer channels scaled to [0, 1), which is the image
+# check() gets from the DNG
+def average_channels(image, bit_depth):
+    h = image.shape[0] // 2 * 2
+    w = image.shape[1] // 2 * 2
+    av_chan = image[0:h:2, 0:w:2].astype(np.float32)
+    av_chan += image[0:h:2, 1:w:2]
+    av_chan += image[1:h:2, 0:w:2]
+    av_chan += image[1:h:2, 1:w:2]
+    av_chan *= 1 / (4 * 2 ** bit_depth)
+    return av_chan
+
+
+# Checks a capture that is already on disk, such as one in a reopened session
+# that was never checked, and notes the result in the manifest. The file is read
+# with the memory-mapped reader, so this is cheap even for large sensors.
+def check(filename):
+    with timeline.span("check"):
+        reason = quick_check_file(filename, json_template)
+    print("Checked %s, reader buffers %.1f MB: %s" % (
+        os.path.basename(filename), quick_check_memory(filename) / 2**20, reason or "passed"))
+    record_check(filename, reason)
+    return reason
+
+
+# Same test as check(), but straight from a still request that is still in memory
+def check_request(burst):
+    with timeline.span("check macbeth"):
+        av_chan = average_channels(burst.average(), burst.bit_depth)
+        blacklevel = np.mean(burst.metadata.get("SensorBlackLevels", (0,))) / (2**16)
+        if np.mean(av_chan) < blacklevel + 1 / 64:
+            return False
+        Cam = Camera("imx.json", json=json_template)
+        return find_macbeth(Cam, av_chan, mac_config=(0, 0)) is not None
+
+
+# Checks a macbeth still and only writes the DNG when the chart is found.
+# Returns whether it was written and, if something went wrong, what it was
+# doing and the exception, ("check", e) or ("write", e).
+def check_and_write(burst, filename):
+    try:
+        if not check_request(burst):
+            return False, None
+    except Exception as e:
+        return False, ("check", e)
+    try:
+        with timeline.span("write still"):
+            write_durably(filename, burst.save_dng)
+    except Exception as e:
+        return False, ("write", e)
+    record_capture(filename, "passed")
+    return True, None
+
+
+# Notes a capture in the session's manifest. A reopened session makes the
+# manifest good from the files themselves, so this failing doesn't fail the capture.
+def record_capture(filename, check):
+    try:
+        session_manifest.record_capture(filename, check)
+    except Exception:
+        traceback.print_exc()
+
+
+def record_check(filename, reason):
+    try:
+        session_manifest.record_check(filename, reason)
+    except Exception:
+        traceback.print_exc()
+
+
+def record_analysis(filename, reason):
+    try:
+        session_manifest.record_analysis(filename, reason)
+    except Exception:
+        traceback.print_exc()
+
+
+# Writes the file under a temporary name and only renames it into place once it
+# is on disk, so that ctt never sees a half written DNG, even after a crash.
+def write_durably(filename, write):
+    part = filename + ".part"
+    try:
+        write(part)
+        with open(part, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(part, filename)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    # makes the rename itself durable
+    directory = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+# number of raw frames averaged into each still of that kind, 1 keeps single frames
+burst_frames = {"macbeth": 4, "alsc": 8, "cac": 1}
+
+
+# Averages raw frames as they arrive. Each one is unpacked and added into a
+# uint32 sum and its buffer handed straight back to the camera, so only one
+# frame is held at a time whatever the length of the burst.
+class RawBurst(BurstSum):
+    def __init__(self):
+        super().__init__()
+        self.metadata = None
+        self.config = None
+
+    def add(self, request):
+        from picamera2 import MappedArray
+        with MappedArray(request, "raw", write=False) as m:
+            image, bit_depth = raw_image(m.array, request.config["raw"])
+            if self.total is None:
+                # the first frame's metadata describes the still, as it would for a single frame
+                self.total = image.astype(np.uint32)
+                self.metadata = request.get_metadata()
+                self.config = request.config["raw"]
+                self.bit_depth = bit_depth
+            else:
+                self.total += image
+        self.count += 1
+
+    # Written as the unpacked format, as picamera2 does for compressed raw
+    def save_dng(self, filename):
+        from picamera2 import SensorFormat
+        average = self.average()
+        fmt = SensorFormat(self.config["format"])
+        config = dict(self.config, format=fmt.unpacked, stride=average.strides[0], framesize=average.nbytes)
+        picam2.helpers.save_dng(average.view(np.uint8).reshape(-1), self.metadata, config, filename)
+
+
+# Switches to the still mode once, averages burst_frames[kind] raw frames and
+# switches back to the preview configuration saved when the camera was
+# configured, never to whatever mode the camera happens to be in. The job's
+# result is the RawBurst.
+def capture_burst(cfg, kind, signal_function):
+    frames = burst_frames[kind]
+    # the replay camera hands back a stored still of the same kind instead
+    if replay_folder:
+        return picam2.capture_burst(kind, frames, signal_function)
+    burst = RawBurst()
+
+    def accumulate_():
+        try:
+            while picam2.completed_requests and burst.count < frames:
+                request = picam2.completed_requests.pop(0)
+                try:
+                    burst.add(request)
+                finally:
+                    request.release()
+        except Exception:
+            picam2.switch_mode_(preview_config)
+            raise
+        if burst.count < frames:
+            return (False, None)
+        picam2.switch_mode_(preview_config)
+        return (True, burst)
+
+    functions = [lambda: picam2.switch_mode_(cfg), accumulate_]
+    return picam2.dispatch_functions(functions, None, signal_function, immediate=True)
 
-    av_chan = (np.mean(np.array(Img.channels), axis=0) / (2 ** 16))
-    av_val = np.mean(av_chan)
 
-    if av_val < Img.blacklevel_16 / (2**16) + 1 / 64:
-        return False
-    else:
-        macbeth = find_macbeth(Cam, av_chan, mac_config=(0, 0))
-    if macbeth is None:
-        return False
+# add camera name to this folder that is default
+def default_folder(model):
+    index_photo = 0
+    list_of_index = []
+    for f in os.listdir(os.path.expanduser("~")):
+        if model in f:
+            if "_" in f:
+                try:  # in case of e.g. "imx708_wide" where we don't have a number after the "_"
+                    list_of_index.append(int(f[f.rindex("_") + 1:]))
+                except Exception:
+                    pass
+            index_photo += 1
+    if index_photo == 0:
+        return os.path.join(os.path.expanduser("~"), model)
+    elif list_of_index == []:
+        return os.path.join(os.path.expanduser("~"), model + "_" + str(index_photo))
     else:
-        return True
+        list_of_index.sort()
+        index_photo = list_of_index[-1] + 1
+        return os.path.join(os.path.expanduser("~"), model + "_" + str(index_photo))
 
 
-# add camera name to this folder that is default
-index_photo = 0
 start = False
-list_of_index = []
-for f in os.listdir(os.path.expanduser("~")):
-    if picam2.global_camera_info()[0]["Model"] in f:
-        if "_" in f:
-            try:  # in case of e.g. "imx708_wide" where we don't have a number after the "_"
-                list_of_index.append(int(f[f.rindex("_") + 1:]))
-            except Exception:
-                pass
-        index_photo += 1
-if index_photo == 0:
-    folder_directory = os.path.join(os.path.expanduser("~"), picam2.global_camera_info()[0]["Model"])
-elif list_of_index == []:
-    folder_directory = os.path.join(os.path.expanduser("~"), picam2.global_camera_info()[0]["Model"] + "_" + str(index_photo))
-else:
-    list_of_index.sort()
-    index_photo = list_of_index[-1] + 1
-    folder_directory = os.path.join(os.path.expanduser("~"), picam2.global_camera_info()[0]["Model"] + "_" + str(index_photo))
-
-# what pi are we working on?
-if Picamera2.platform == Platform.PISP:
-    target = "pi5"
-    from ctt_pisp import json_template
-else:
-    target = "pi4"
-    from ctt_vc4 import json_template
 
 
 # checks if sting is a valid path to a folder
@@ -127,10 +421,7 @@ def valid_path(s):
 
 
 # create the screen that shades if it can se a macbeth plote clos to camera
-# macbeth reference data
-Cam = Camera("dummy_name.json", json=json_template)
-s = os.path.join(Cam.path, 'ctt_ref.pgm')
-ref = cv2.imread(s, flags=cv2.IMREAD_GRAYSCALE)
+# macbeth reference data, the image itself is read by load_ctt()
 ref_w = 120
 ref_h = 80
 rc1 = (0, 0)
@@ -138,141 +429,725 @@ rc2 = (0, ref_h)
 rc3 = (ref_w, ref_h)
 rc4 = (ref_w, 0)
 ref_corns = np.array((rc1, rc2, rc3, rc4), np.float32)
-ref_data = (ref, ref_w, ref_h, ref_corns)
 
 # function that checks for macbeth close to camera
+# The frame is tried first at the gain that found the chart in the previous
+# frame. Only if that doesn't find it well enough is it tried brightened up by
+# each of the other gains, all at the same time.
+macbeth_gains = (1, 2, 4)
+last_gain = 1
+gain_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def find_macbeth_at_gain(img, gain):
+    if gain != 1:
+        img = cv2.convertScaleAbs(img, alpha=gain, beta=0)
+    return get_macbeth_chart(img, ref_data)
 
 
 def my_find_macbeth(img):
+    global last_gain
     warnings.simplefilter("ignore")
     fxn()
-    cor, mac, coords, msg = get_macbeth_chart(img, ref_data)
-    if cor < 0.75:
-        a = 2
-        img_br = cv2.convertScaleAbs(img, alpha=a, beta=0)
-        cor_b, mac_b, coords_b, msg_b = get_macbeth_chart(img_br, ref_data)
-        if cor_b > cor:
-            cor, _, coords, _ = cor_b, mac_b, coords_b, msg_b
-    if cor < 0.75:
-        a = 4
-        img_br = cv2.convertScaleAbs(img, alpha=a, beta=0)
-        cor_b, mac_b, coords_b, msg_b = get_macbeth_chart(img_br, ref_data)
-        if cor_b > cor:
-            cor, _, coords, _ = cor_b, mac_b, coords_b, msg_b
+    with timeline.span("find macbeth") as args:
+        gain = last_gain
+        cor, _, coords, _ = find_macbeth_at_gain(img, gain)
+        futures = {}
+        if cor < 0.75:
+            futures = {gain_pool.submit(find_macbeth_at_gain, img, g): g for g in macbeth_gains if g != last_gain}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    cor_b, _, coords_b, _ = future.result()
+                    if cor_b > cor:
+                        cor, coords, gain = cor_b, coords_b, futures[future]
+                # good enough, don't wait for the other gains
+                if cor >= 0.75:
+                    for future in pending:
+                        future.cancel()
+                    break
+        # how many gains had to be tried
+        args["gains"] = 1 + sum(future.done() and not future.cancelled() for future in futures)
+        args["gain"] = gain
     if cor > 0.5:
-        return (cor, coords)
+        last_gain = gain
+        return (cor, np.asarray(coords[0], dtype=np.float32).reshape(4, 2))
     else:
         return (0, None)
 
+
+# Tracking mode: once the chart has been found, the next frames are only searched
+# in a crop around where it was, at the gain that found it. The whole frame is
+# searched again only when the chart is lost from the crop.
+macbeth_tracking = True
+
+
+class MacbethTracker:
+    def __init__(self, margin=0.5):
+        # how much bigger than the chart the crop is on each side
+        self.margin = margin
+        self.quad = None
+        self.lock = threading.Lock()
+        # whole frame searches, shown under the preview so that it can be seen
+        # they only happen when the chart is lost
+        self.full_searches = 0
+
+    def detect(self, img):
+        with self.lock:
+            quad = self.quad
+        if quad is not None:
+            cor, found = self.search_crop(img, quad)
+            if found is not None:
+                with self.lock:
+                    self.quad = found
+                return (cor, found)
+        with self.lock:
+            self.full_searches += 1
+        cor, found = my_find_macbeth(img)
+        with self.lock:
+            self.quad = found
+        return (cor, found)
+
+    def search_crop(self, img, quad):
+        h, w = img.shape[:2]
+        (x0, y0), (x1, y1) = quad.min(axis=0), quad.max(axis=0)
+        mx, my = (x1 - x0) * self.margin, (y1 - y0) * self.margin
+        x0, y0 = max(int(x0 - mx), 0), max(int(y0 - my), 0)
+        x1, y1 = min(int(x1 + mx) + 1, w), min(int(y1 + my) + 1, h)
+        if x1 - x0 < ref_w or y1 - y0 < ref_h:
+            return (0, None)
+        warnings.simplefilter("ignore")
+        with timeline.span("search crop"):
+            cor, _, coords, _ = find_macbeth_at_gain(np.ascontiguousarray(img[y0:y1, x0:x1]), last_gain)
+        if cor > 0.5:
+            return (cor, np.asarray(coords[0], dtype=np.float32).reshape(4, 2) + (x0, y0))
+        return (0, None)
+
+
+# Smooths the chart corners over successive detections. A miss lowers the
+# confidence instead of removing the box, so it only goes once the chart has
+# been missed for about 10 frames in a row.
+class QuadFilter:
+    def __init__(self, smoothing=0.5, decay=0.8, threshold=0.1):
+        self.smoothing = smoothing
+        self.decay = decay
+        self.threshold = threshold
+        self.quad = None
+        self.confidence = 0.0
+
+    def update(self, quad):
+        if quad is None:
+            self.confidence *= self.decay
+        else:
+            # jump straight to a chart that has moved a long way rather than sliding over
+            if self.quad is None or np.abs(quad - self.quad).max() > np.ptp(quad, axis=0).max() / 4:
+                self.quad = quad
+            else:
+                self.quad = self.quad + self.smoothing * (quad - self.quad)
+            self.confidence = 1.0
+        return self.visible()
+
+    def visible(self):
+        return self.quad is not None and self.confidence > self.threshold
+
+
+# preview levels, out of 1, that decide whether a still is worth taking
+min_preview_level = 0.1
+clip_level = 250 / 255
+# fraction of the frame (lens shading) or of the chart (macbeth) allowed to be clipped
+max_clipped_fraction = 0.02
+max_chart_clipped = 0.002
+
+
+# The mean level and clipped fraction of a preview frame, and the clipped
+# fraction inside the chart's quad if there is one. Every other pixel in each
+# direction is enough for a meter.
+def exposure_stats(array, quad=None):
+    frame = array[::2, ::2]
+    if frame.ndim == 3:
+        # XBGR or BGR, a pixel is clipped when any of its colours is
+        frame = frame[:, :, :3]
+        level = frame.mean() / 255
+        clipped = frame.max(axis=2) >= clip_level * 255
+    else:
+        level = frame.mean() / 255
+        clipped = frame >= clip_level * 255
+    chart_clipped = 0.0
+    if quad is not None:
+        mask = np.zeros(clipped.shape, dtype=np.uint8)
+        cv2.fillConvexPoly(mask, np.round(quad / 2).astype(np.int32), 1)
+        inside = np.count_nonzero(mask)
+        if inside:
+            chart_clipped = np.count_nonzero(clipped & mask.view(bool)) / inside
+    return level, np.count_nonzero(clipped) / clipped.size, chart_clipped
+
+
+# Why a still of this kind shouldn't be taken with the exposure the preview
+# shows, or None if it is fine
+def exposure_problem(exposure, kind):
+    if exposure is None:
+        return None
+    level, clipped, chart_clipped = exposure
+    if level < min_preview_level:
+        return "Too dark, please fix the lighting"
+    elif kind in ("alsc", "cac") and clipped > max_clipped_fraction:
+        return "Too bright, the image is clipped"
+    elif kind == "macbeth" and chart_clipped > max_chart_clipped:
+        return "Too bright, the chart is clipped"
+    return None
+
+
+# how much brighter or darker, as a fraction of the brightest cell, a lens
+# shading cell may be than the cell mirroring it across the centre. The lens's
+# own shading is close to symmetric, so more than this is the lighting.
+max_shading_asymmetry = 0.15
+
+
+# The mean of each cell of a (columns, rows) grid over a 2d image
+def block_means(image, grid):
+    columns, rows = grid
+    h = image.shape[0] // rows * rows
+    w = image.shape[1] // columns * columns
+    return image[:h, :w].reshape(rows, h // rows, columns, w // columns).mean(axis=(1, 3))
+
+
+# Marks each cell of a grid of lens shading levels, out of 1: 2 where it is
+# clipped, 1 where it is too far from its mirror images, otherwise 0
+def shading_flags(means):
+    mirror = np.maximum(np.abs(means - means[:, ::-1]), np.abs(means - means[::-1, :]))
+    flags = (mirror > max_shading_asymmetry * means.max()).astype(np.uint8)
+    flags[means >= clip_level] = 2
+    return flags
+
+
+def shading_problem(flags):
+    if (flags == 2).any():
+        return "Too bright, the image is clipped"
+    elif (flags == 1).any():
+        return "Not evenly lit, please check the diffuser"
+    return None
+
+
+# The same check on a captured lens shading still, using every fourth Bayer
+# quad of the frame sum, without making the full averaged image. Evenness is
+# judged on the average of the four channels, but one channel can clip while
+# the others keep that average down, so clipping is looked for in each.
+def check_shading(burst):
+    h = burst.total.shape[0] // 2 * 2
+    w = burst.total.shape[1] // 2 * 2
+    quads = burst.total[:h, :w].reshape(h // 2, 2, w // 2, 2)[::4, :, ::4, :]
+    black = np.mean(burst.metadata.get("SensorBlackLevels", (0,))) / 2 ** (16 - burst.bit_depth)
+    levels = (quads / burst.count - black) / (2 ** burst.bit_depth - 1 - black)
+    flags = shading_flags(block_means(levels.mean(axis=(1, 3)), grid_size))
+    channels = [block_means(levels[:, i, :, j], grid_size) for i in (0, 1) for j in (0, 1)]
+    flags[np.max(channels, axis=0) >= clip_level] = 2
+    return shading_problem(flags)
+
+
+# The dot grid in a preview frame, for the cac tab
+def find_dots(array):
+    frame = array[:, :, :3].mean(axis=2).astype(np.uint8) if array.ndim == 3 else array
+    return find_dot_grid(frame)
+
+
+# The same check on a captured cac still, from the Bayer quads of the frame sum
+# at about the width the preview is checked at
+def check_cac(burst):
+    h = burst.total.shape[0] // 2 * 2
+    w = burst.total.shape[1] // 2 * 2
+    step = max(1, w // 2 // cac_check_width)
+    quads = burst.total[:h, :w].reshape(h // 2, 2, w // 2, 2)[::step, :, ::step, :]
+    black = np.mean(burst.metadata.get("SensorBlackLevels", (0,))) / 2 ** (16 - burst.bit_depth)
+    return cac_check(quads.mean(axis=(1, 3)) / burst.count, black)
+
+
+still_checks = {"alsc": ("check shading", check_shading), "cac": ("check dots", check_cac)}
+
+
+# Writes a lens shading or cac still, returning why it was rejected if it wasn't
+def save_still(burst, filename):
+    span, check = still_checks[capture_kind(filename)]
+    with timeline.span(span):
+        reason = check(burst)
+    if reason is not None:
+        return reason
+    with timeline.span("write still"):
+        write_durably(filename, burst.save_dng)
+        record_capture(filename, "passed")
+    return None
+
+
 # future parameters
 
 
 pool = ThreadPoolExecutor(max_workers=4)
+# macbeth captures are checked one at a time, away from the Qt thread
+check_pool = ThreadPoolExecutor(max_workers=1)
+# lens shading and cac stills are written here, while the preview carries on
+write_pool = ThreadPoolExecutor(max_workers=1)
+# each still waiting to be written holds its averaged frame, so no more than this are queued
+max_pending_writes = 3
 overlay_active = False
 busy = False
+# how many preview frames can be searched for the chart at the same time
+detections_in_flight = 3
+# the green box is only redrawn when a corner moves by more than this many preview pixels
+overlay_threshold = 2
+
+
+# Runs detections on the pool, keeping up to max_in_flight of them going at once.
+# A frame that arrives while they are all busy replaces any frame that is still
+# waiting, so the next detection always gets the newest frame. Results come back
+# in frame order through result_signal, with the time.monotonic() the frame was
+# submitted at.
+class DetectionScheduler(QObject):
+    result_signal = pyqtSignal(object, object, float)
+    finished_signal = pyqtSignal(int, object, object, float)
+
+    def __init__(self, detect, max_in_flight=2, executor=pool, parent=None):
+        super().__init__(parent)
+        self.detect = detect
+        self.max_in_flight = max_in_flight
+        self.executor = executor
+        self.next_frame = 0
+        self.next_result = 0
+        self.in_flight = 0
+        self.waiting = None
+        self.finished = {}
+        # frames replaced before they were detected, and when results were delivered
+        self.dropped = 0
+        self.delivered = deque(maxlen=30)
+        self.finished_signal.connect(self.detection_finished)
+
+    def submit(self, frame):
+        arrived = time.monotonic()
+        if self.in_flight < self.max_in_flight:
+            self.start(frame, arrived)
+        else:
+            if self.waiting is not None:
+                self.dropped += 1
+            self.waiting = (frame, arrived)
+
+    def start(self, frame, arrived):
+        number = self.next_frame
+        self.next_frame += 1
+        self.in_flight += 1
+        future = self.executor.submit(self.detect, frame)
+        # runs in the worker thread, the signal brings the result back to the Qt thread
+        future.add_done_callback(lambda f: self.finished_signal.emit(number, frame, f, arrived))
+
+    def detection_finished(self, number, frame, future, arrived):
+        self.in_flight -= 1
+        self.finished[number] = (frame, future, arrived)
+        while self.next_result in self.finished:
+            frame, future, arrived = self.finished.pop(self.next_result)
+            self.next_result += 1
+            e = future.exception()
+            if e is not None:
+                traceback.print_exception(type(e), e, e.__traceback__)
+                continue
+            self.delivered.append(time.monotonic())
+            self.result_signal.emit(frame, future.result(), arrived)
+        if self.waiting is not None:
+            (frame, arrived), self.waiting = self.waiting, None
+            self.start(frame, arrived)
+
+    # detections delivered per second over the last few results
+    def rate(self):
+        if len(self.delivered) < 2 or self.delivered[-1] == self.delivered[0]:
+            return 0.0
+        return (len(self.delivered) - 1) / (self.delivered[-1] - self.delivered[0])
+
 
 # Class that makes the wisget itself that will enclose macbeth if it sees it
 
 
 class MacbethWindow(QWidget):
-    done_signal = pyqtSignal()
+    done_signal = pyqtSignal(object)
+    # emitted when the reasons not to capture change
+    problems_signal = pyqtSignal()
 
     def __init__(self, *args, **kwargs):
         super(QWidget, self).__init__(*args, **kwargs)
+        if replay_folder:
+            from replay_camera import ReplayPreview as QGlPicamera2
+        else:
+            from picamera2.previews.qt import QGlPicamera2
         self.qpicamera2 = QGlPicamera2(picam2, width=800, height=600, keep_ar=True, bg_colour=(236, 236, 236))
         self.qpicamera2.done_signal.connect(self.capture_done)
 
         self.window = QWidget()
         self.layout_h = QHBoxLayout()
         self.layout_h.addWidget(self.qpicamera2, 80)
+        # live frame and detection rates under the preview
+        self.stats_label = QLabel()
+        self.layout_v = QVBoxLayout()
+        self.layout_v.addLayout(self.layout_h)
+        self.layout_v.addWidget(self.stats_label)
         self.window.resize(1200, 600)
-        self.window.setLayout(self.layout_h)
+        self.window.setLayout(self.layout_v)
 
         QTimer.singleShot(0, self.request_frame)
         picam2.start()
 
-        self.count = 0
-        self.futures = []
-        # to make the green macbeth frame more stabile, we remove it when not dettected for 10 periods
-        self.macbeth_glitch = 0
+        self.tracker = MacbethTracker()
+        detect = self.tracker.detect if macbeth_tracking else my_find_macbeth
+        self.scheduler = DetectionScheduler(detect, max_in_flight=detections_in_flight)
+        self.scheduler.result_signal.connect(self.detection_done)
+        # the cac tab looks for the dot chart instead, one frame at a time
+        self.dot_scheduler = DetectionScheduler(find_dots, max_in_flight=1)
+        self.dot_scheduler.result_signal.connect(self.cac_done)
+        # to make the green macbeth frame more stabile, its corners are smoothed over several detections
+        self.quad_filter = QuadFilter()
+        # the overlay matches the preview, and the quad it currently shows (None when hidden)
+        self.overlay = np.zeros((main["size"][1], main["size"][0], 4), dtype=np.uint8)
+        self.overlay_quad = None
+        # the exposure of the latest preview frame that was searched for the chart
+        self.exposure = None
+        # the lens shading tab shows how evenly lit the frame is instead of the
+        # chart, and the cac tab where the dots are missing or blurred. The grid
+        # flags are the ones the overlay currently shows.
+        self.mode = "macbeth"
+        self.grid_flags = None
+        self.shading_problem = None
+        self.cac_problem = None
+        # dots found, coverage and sharpness of the latest cac frame
+        self.cac_stats = None
+        # why a macbeth, lens shading or cac still shouldn't be taken now, None if it can be
+        self.problems = (None, None, None)
+        # set when the frame loop stopped because a still was being taken
+        self.paused = False
+        # when recent preview frames arrived and whether the chart was found in recent results
+        self.frame_start = None
+        self.frames = deque(maxlen=30)
+        self.found = deque(maxlen=30)
+        # seconds from a frame arriving to the overlay showing its result
+        self.latencies = deque(maxlen=30)
+        self.stats_time = 0
+
+    def set_mode(self, mode):
+        global overlay_active
+        self.mode = mode
+        self.exposure = None
+        self.grid_flags = None
+        self.shading_problem = None
+        self.cac_problem = None
+        self.cac_stats = None
+        self.overlay_quad = None
+        overlay_active = False
+        self.set_overlay(None)
+        self.update_problems()
+
+    # nothing is captured while the preview shows it would be badly exposed
+    def update_problems(self):
+        problems = (exposure_problem(self.exposure, "macbeth"),
+                    exposure_problem(self.exposure, "alsc") or self.shading_problem,
+                    exposure_problem(self.exposure, "cac") or self.cac_problem)
+        if problems != self.problems:
+            self.problems = problems
+            self.problems_signal.emit()
+
+    def set_overlay(self, overlay):
+        try:
+            self.qpicamera2.set_overlay(overlay)
+        except RuntimeError:
+            pass
 
     def request_frame(self):
+        self.paused = busy
         if not busy:
-            picam2.capture_array(signal_function=self.qpicamera2.signal_done)
+            self.frame_start = timeline.now()
+            picam2.capture_array(detect_stream, signal_function=self.qpicamera2.signal_done)
+
+    # starts the frame loop again once the still has been taken
+    def resume(self):
+        if self.paused:
+            self.request_frame()
 
     def signal_done(self, job):
-        self.done_signal.emit()
+        self.done_signal.emit(job)
 
     def capture_done(self, job):
-        global overlay_active
+        startup_time("first preview")
+        timeline.record("preview frame", self.frame_start)
+        self.frames.append(time.monotonic())
+        self.update_stats()
         array = job.get_result()
-        if self.count < 1:
-            # add another future
-            future = pool.submit(my_find_macbeth, array)
-            self.futures.append(future)
-            self.count += 1
-
-        if self.futures:
-            if self.futures[0].running() is False:
-                cor, macbeth = self.futures[0].result()
-                self.futures.pop(0)
-                self.count -= 1
-                # OVERLAY
-                if cor != 0:
-                    overlay_active = True
-                    self.macbeth_glitch = 0
-                    h = array.shape[0]
-                    w = array.shape[1]
-                    m = macbeth[0].astype(np.int64)
-                    for i in range(4):
-                        m[0][i][0] = int(round(m[0][i][0] * 800 / w))
-                        m[0][i][1] = int(round(m[0][i][1] * 800 / h))
-
-                    overlay = np.zeros((800, 800, 4), dtype=np.uint8)
-                    cv2.polylines(img=overlay, pts=m, isClosed=True, color=(0, 255, 0, 100), thickness=5)
-                    try:
-                        self.qpicamera2.set_overlay(overlay)
-                    except RuntimeError:
-                        pass
-                elif self.macbeth_glitch > 10:
-                    overlay_active = False
-                    self.filter_machb = 0
-                    overlay = np.zeros((800, 800, 4), dtype=np.uint8)
-                    try:
-                        self.qpicamera2.set_overlay(overlay)
-                    except RuntimeError:
-                        pass
-                else:
-                    self.macbeth_glitch += 1
-
+        if detect_stream == "lores":
+            # the Y plane is the top of the YUV420 buffer, this is only a view of it
+            w, h = picam2.camera_config["lores"]["size"]
+            array = array[:h, :w]
+        if self.mode == "alsc":
+            self.shading_done(array)
+        elif self.mode == "cac":
+            self.dot_scheduler.submit(array)
+        else:
+            self.scheduler.submit(array)
         QTimer.singleShot(1, self.request_frame)
 
+    # shown about once a second, and recorded on the timeline
+    def update_stats(self):
+        now = time.monotonic()
+        if now - self.stats_time < 1 or len(self.frames) < 2:
+            return
+        self.stats_time = now
+        fps = (len(self.frames) - 1) / max(self.frames[-1] - self.frames[0], 1e-6)
+        found = 100 * sum(self.found) / len(self.found) if self.found else 0
+        latency = 1000 * float(np.median(self.latencies)) if self.latencies else 0
+        if self.mode == "cac" and self.cac_stats is not None:
+            dots, coverage, sharpness = self.cac_stats
+            self.stats_label.setText("Preview %.1f fps, %d dots covering %d%% of the frame, sharpness %.2f (%.2f needed)" % (
+                fps, dots, 100 * coverage, sharpness, min_cac_sharpness))
+            timeline.counter("cac chart", dots=dots, coverage=coverage, sharpness=sharpness)
+        else:
+            text = "Preview %.1f fps, detection %.1f/s, latency %d ms, chart found in %d%% of recent frames, %d dropped" % (
+                fps, self.scheduler.rate(), latency, found, self.scheduler.dropped)
+            if macbeth_tracking:
+                text += ", %d full searches" % self.tracker.full_searches
+            self.stats_label.setText(text)
+        timeline.counter("rates", preview_fps=fps, detection_rate=self.scheduler.rate())
+        if macbeth_tracking:
+            timeline.counter("full searches", full_searches=self.tracker.full_searches)
+        timeline.counter("latency", frame_to_overlay_ms=latency)
+        timeline.counter("dropped frames", dropped=self.scheduler.dropped)
+
+    # Lens shading grid, worked out on every frame as it is cheap. The cells are
+    # coloured orange where the lighting is uneven and red where it is clipped,
+    # and only redrawn when that changes.
+    def shading_done(self, array):
+        with timeline.span("shading grid"):
+            self.exposure = exposure_stats(array)
+            frame = array[:, :, :3].mean(axis=2) if array.ndim == 3 else array
+            flags = shading_flags(block_means(frame, grid_size) / 255)
+        self.shading_problem = shading_problem(flags)
+        self.update_problems()
+        self.draw_grid(flags)
+
+    # The dot grid of a cac frame. The cells are coloured orange where there
+    # are no dots and red where they are blurred.
+    def cac_done(self, array, result, arrived):
+        if self.mode != "cac":
+            return
+        self.exposure = exposure_stats(array)
+        dots, coverage, sharpness, flags = result
+        self.cac_stats = (len(dots), coverage, sharpness)
+        self.cac_problem = cac_problem(*self.cac_stats)
+        self.update_problems()
+        self.draw_grid(flags)
+
+    # a grid of cells flagged 0, 1 or 2 over the preview, only redrawn when it changes
+    def draw_grid(self, flags):
+        if self.grid_flags is not None and np.array_equal(flags, self.grid_flags):
+            return
+        self.grid_flags = flags
+        with timeline.span("overlay"):
+            oh, ow = self.overlay.shape[:2]
+            rows, columns = flags.shape
+            colours = np.array([(0, 0, 0, 0), (255, 160, 0, 100), (255, 0, 0, 100)], dtype=np.uint8)
+            self.overlay[:] = cv2.resize(colours[flags], (ow, oh), interpolation=cv2.INTER_NEAREST)
+            self.overlay[np.arange(1, rows) * oh // rows, :] = (255, 255, 255, 60)
+            self.overlay[:, np.arange(1, columns) * ow // columns] = (255, 255, 255, 60)
+            self.set_overlay(self.overlay)
+
+    # for each detection result in frame order
+    def detection_done(self, array, result, arrived):
+        if self.mode != "macbeth":
+            return
+        self.update_overlay(array, result)
+        self.latencies.append(time.monotonic() - arrived)
+
+    # OVERLAY. The quad is in the coordinates of the detection stream, so it is
+    # scaled by that frame's size. The box is only redrawn when it moves or
+    # appears, and hidden when it goes.
+    def update_overlay(self, array, result):
+        global overlay_active
+        cor, quad = result
+        self.found.append(quad is not None)
+        overlay_active = self.quad_filter.update(quad)
+        self.exposure = exposure_stats(array, self.quad_filter.quad if overlay_active else None)
+        self.update_problems()
+        if overlay_active:
+            h, w = array.shape[:2]
+            oh, ow = self.overlay.shape[:2]
+            m = self.quad_filter.quad * (ow / w, oh / h)
+            if self.overlay_quad is not None and np.abs(m - self.overlay_quad).max() <= overlay_threshold:
+                return
+            self.overlay_quad = m
+            overlay = self.overlay
+        elif self.overlay_quad is not None:
+            self.overlay_quad = None
+            overlay = None
+        else:
+            return
+        with timeline.span("overlay"):
+            if overlay is not None:
+                overlay[:] = 0
+                pts = [np.round(m).astype(np.int32)]
+                cv2.polylines(img=overlay, pts=pts, isClosed=True, color=(0, 255, 0, 100), thickness=5)
+            self.set_overlay(overlay)
+
+
+# Runs one ctt target in a ctt_worker.py process and keeps track of the
+# progress it reports on its stdout
+ctt_worker = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ctt_worker.py")
+
+
+class CttProcess(QProcess):
+    progress_signal = pyqtSignal()
+
+    def __init__(self, target, folder, parent=None):
+        super().__init__(parent)
+        self.target = target
+        self.stage = "waiting"
+        self.step = 0
+        self.steps = 1
+        # each stage, and the whole run, is drawn on a line of its own in the timeline
+        self.run_start = None
+        self.stage_start = None
+        self.started.connect(self.run_started)
+        self.finished.connect(self.run_finished)
+        # ctt's own output still goes to the terminal
+        self.setProcessChannelMode(QProcess.ForwardedErrorChannel)
+        self.readyReadStandardOutput.connect(self.read_progress)
+        self.setProgram(sys.executable)
+        self.setArguments([ctt_worker, target, folder])
+
+    def run_started(self):
+        self.run_start = self.stage_start = timeline.now()
+
+    def run_finished(self, *args):
+        timeline.record(self.stage, self.stage_start, thread="ctt " + self.target)
+        timeline.record("ctt " + self.target, self.run_start, thread="ctt " + self.target)
+
+    def read_progress(self):
+        while self.canReadLine():
+            line = bytes(self.readLine()).decode(errors="replace")
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if message.get("stage", self.stage) != self.stage:
+                timeline.record(self.stage, self.stage_start, thread="ctt " + self.target)
+                self.stage_start = timeline.now()
+            self.stage = message.get("stage", self.stage)
+            self.step = message.get("step", self.step)
+            self.steps = max(message.get("steps", self.steps), 1)
+        self.progress_signal.emit()
+
+    def failed(self):
+        return self.error() == QProcess.FailedToStart or self.exitStatus() != QProcess.NormalExit or self.exitCode() != 0
+
+
+# Decodes each capture and finds its chart into the session cache as soon as it
+# is saved, so that by the time Done is pressed ctt only has to put the results
+# together. Files still waiting when ctt starts are picked up by whichever
+# process gets to them first.
+class PrepareProcess(QProcess):
+    prepared_signal = pyqtSignal(str, object)
+
+    def __init__(self, folder, parent=None):
+        super().__init__(parent)
+        self.pending = []
+        self.setProcessChannelMode(QProcess.ForwardedErrorChannel)
+        self.readyReadStandardOutput.connect(self.read_progress)
+        self.setProgram(sys.executable)
+        self.setArguments([ctt_worker, "prepare", folder])
+
+    def add(self, filename):
+        if self.state() == QProcess.NotRunning:
+            self.start()
+        self.pending.append(filename)
+        self.write((filename + "\n").encode())
+
+    # lets the worker exit once it has got through what it was given
+    def finish(self):
+        if self.state() != QProcess.NotRunning:
+            self.closeWriteChannel()
+
+    def read_progress(self):
+        while self.canReadLine():
+            line = bytes(self.readLine()).decode(errors="replace")
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if message.get("file") in self.pending:
+                self.pending.remove(message["file"])
+            self.prepared_signal.emit(message.get("file", ""), message.get("reason"))
+
 
 # Create an app that asks for file directory, with the suggested name
 class FirstWindow(QWidget):
+    folder_signal = pyqtSignal(str)
+    ready_signal = pyqtSignal(str)
+
     def __init__(self):
         super().__init__()
         layout = QVBoxLayout()
         self.folder_directory = QLineEdit()
-        self.folder_directory.setText(folder_directory)
+        self.folder_directory.setPlaceholderText("Finding camera...")
         self.label = QLabel()
-        self.label.setText("Button will be grayed out for incorrect, or already exsting, folder paths.")
-        self.button_initialise = QPushButton("Next")
+        self.label.setText("Button will be grayed out for incorrect, or already exsting, folder paths. "
+                           "An earlier session's folder can be continued.")
+        self.button_initialise = QPushButton("Starting camera...")
         self.button_initialise.clicked.connect(self.push_button)
         layout.addWidget(self.label)
         layout.addWidget(self.folder_directory)
         layout.addWidget(self.button_initialise)
         self.setLayout(layout)
-        self._timer = QTimer()
-        self._timer.timeout.connect(self.onTimeout)
-        self._timer.start()
+
+        # the camera is started in the background while the folder is chosen
+        self.ready = False
+        self.folder_directory.textChanged.connect(self.update_button)
+        self.update_button()
+        self.folder_signal.connect(self.folder_found)
+        self.ready_signal.connect(self.camera_ready)
+        threading.Thread(target=self.load_camera, daemon=True).start()
         self.show()
+        QTimer.singleShot(0, lambda: startup_time("first window"))
+
+    def load_camera(self):
+        try:
+            load_camera(self.folder_signal.emit)
+        except Exception as e:
+            traceback.print_exc()
+            self.ready_signal.emit(str(e))
+        else:
+            self.ready_signal.emit("")
 
-    # grey out if input is not path to folder
-    def onTimeout(self):
+    def folder_found(self, folder):
+        global folder_directory
+        folder_directory = folder
+        if camera_count > 1:
+            self.setWindowTitle("Tuning Application - camera " + str(camera_num))
         if self.folder_directory.text() == "":
+            self.folder_directory.setText(folder)
+
+    def camera_ready(self, error):
+        if error:
+            dialogue = QMessageBox()
+            dialogue.setWindowTitle("ERROR")
+            dialogue.setText("Could not start the camera: " + error)
+            dialogue.exec()
+            self.close()
+            return
+        self.ready = True
+        self.update_button()
+
+    # grey out if input is not path to folder, or the camera isn't ready yet
+    def update_button(self):
+        if self.ready:
+            self.button_initialise.setText("Next")
+        if not self.ready:
+            self.button_initialise.setDisabled(True)
+        elif self.folder_directory.text() == "":
             self.button_initialise.setDisabled(False)
             return 0
+        # an earlier session, which can be carried on
+        elif session_manifest.is_session(self.folder_directory.text()):
+            self.button_initialise.setText("Continue session")
+            self.button_initialise.setDisabled(False)
         # already exists folder with this name
         elif os.path.exists(self.folder_directory.text()) is True:
             self.button_initialise.setDisabled(True)
@@ -283,14 +1158,21 @@ class FirstWindow(QWidget):
 
     def push_button(self):
         global folder_directory, start
+        folder = self.folder_directory.text() or folder_directory
+        # the folder may have been made since the path was typed
+        if os.path.exists(folder) and not session_manifest.is_session(folder):
+            self.update_button()
+            return
+        os.makedirs(folder, exist_ok=True)
+        model = session_manifest.start(folder, camera_model, target)
+        if model != camera_model:
+            dialogue = QMessageBox()
+            dialogue.setWindowTitle("ERROR")
+            dialogue.setText("This session was started with the " + model + " camera, not the " + camera_model + ".")
+            dialogue.exec()
+            return
+        folder_directory = folder
         start = True
-        if self.folder_directory.text() == "":
-            if os.path.exists(folder_directory):
-                shutil.rmtree(folder_directory)
-            os.makedirs(folder_directory)
-        else:
-            os.makedirs(self.folder_directory.text())
-            folder_directory = self.folder_directory.text()
         self.close()
 
 
@@ -299,6 +1181,8 @@ class App(QMainWindow):
     def __init__(self):
         super().__init__()
         self.title = "Tuning Application"
+        if camera_count > 1:
+            self.title += " - camera " + str(camera_num)
         self.left = 0
         self.top = 0
         self.width = 1400
@@ -318,6 +1202,10 @@ class App(QMainWindow):
 
 class MyTabWidget(QWidget):
     done_signal = pyqtSignal()
+    check_signal = pyqtSignal(object, bool, object)
+    saved_signal = pyqtSignal(str, object)
+    restored_signal = pyqtSignal(object)
+    restored_check_signal = pyqtSignal(str, object)
 
     def __init__(self, parent):
         super(QWidget, self).__init__(parent)
@@ -411,6 +1299,7 @@ class MyTabWidget(QWidget):
         self.qpicamera2 = MacbethWindow()
         self.layout.addWidget(self.qpicamera2.window, 80)
         self.qpicamera2.done_signal.connect(self.capture_done)
+        self.tabs.currentChanged.connect(lambda index: self.qpicamera2.set_mode(("macbeth", "alsc", "cac")[index]))
         picam2.start()
 
         # Add tabs to widget
@@ -420,11 +1309,11 @@ class MyTabWidget(QWidget):
         # Show layot in window
         self.setLayout(self.layout)
 
-        # Updates whetehr input is adequate live time
-        self._timer = QTimer()
-        self._timer.setInterval(20)
-        self._timer.timeout.connect(self.onTimeout)
-        self._timer.start()
+        # Updates whether input is adequate as it changes
+        self.temperature_tab1.textChanged.connect(self.update_buttons)
+        self.lux_tab1.textChanged.connect(self.update_buttons)
+        self.temperature_tab2.textChanged.connect(self.update_buttons)
+        self.qpicamera2.problems_signal.connect(self.update_buttons)
 
         # To know whether at capture image there is a green box on the screen
         self.overlay_active = False
@@ -435,23 +1324,143 @@ class MyTabWidget(QWidget):
         self.cac_used = 0
         self.macbeth_bool = False
         self.list_of_files = []
-
-    # grey out if input is not in good form
-    def onTimeout(self):
+        # captures that have been started but not written yet, in order
+        self.pending_captures = []
+        # stills that are still being captured or written, with their list entry and temperature
+        self.writing = {}
+        self.check_signal.connect(self.check_done)
+        self.saved_signal.connect(self.saved)
+        # each capture is analysed for ctt in the background once it is written
+        self.prepare_process = PrepareProcess(folder_directory, self)
+        self.prepare_process.prepared_signal.connect(self.prepared)
+        self.ctt_running = False
+        # A reopened session carries on from the captures already in its folder.
+        # Nothing is captured until the lists have been filled in from them.
+        self.restoring = True
+        self.restored_signal.connect(self.restored)
+        # Its captures that were never checked are checked before ctt can be run,
+        # and those that fail are taken out of the session
+        self.unchecked = set()
+        self.rejected = []
+        self.restored_check_signal.connect(self.restored_check_done)
+        self.restore_session()
+        self.update_buttons()
+        # the timeline, if it is being recorded, goes with the captures
+        timeline.start(folder_directory)
+
+    # Brings the session's manifest up to date away from the Qt thread, as any
+    # capture it doesn't know about yet has to be read in full to be hashed
+    def restore_session(self):
+        future = write_pool.submit(session_manifest.captures, folder_directory)
+        future.add_done_callback(lambda f: self.restored_signal.emit(f.exception() or f.result()))
+
+    # Fills in the lists from the manifest. Anything the background analysis
+    # hasn't seen yet, or that has changed since, is given to it again once it
+    # is known to have passed its check.
+    def restored(self, captures):
+        self.restoring = False
+        if isinstance(captures, Exception):
+            traceback.print_exception(type(captures), captures, captures.__traceback__)
+            captures = {}
+        for name, entry in captures.items():
+            if entry["kind"] == "macbeth" and "lux" in entry:
+                self.macbeth_used.append(entry["temperature"])
+                self.list_of_files.append(name)
+            elif entry["kind"] == "alsc" and "temperature" in entry:
+                self.alsc_used.append(entry["temperature"])
+                self.listWidget_shading.addItem(name)
+            elif entry["kind"] == "cac":
+                self.cac_used = max(self.cac_used, entry.get("index", 0))
+            filename = os.path.join(folder_directory, name)
+            if entry["check"] is None:
+                self.unchecked.add(filename)
+                future = check_pool.submit(check, filename)
+                future.add_done_callback(
+                    lambda f, filename=filename: self.restored_check_signal.emit(filename, f.exception() or f.result()))
+            elif entry["check"] != "passed":
+                # failed when the app was last run, but wasn't taken out in time
+                self.unchecked.add(filename)
+                QTimer.singleShot(0, lambda filename=filename, reason=entry["check"]:
+                                  self.restored_check_done(filename, reason))
+            elif entry["analysis"] is None:
+                self.prepare_process.add(filename)
+        self.listWidget_macbeth.addItems(self.list_of_files)
+        startup_time("restore the session")
+        self.update_buttons()
+
+    # reason is why a capture of a reopened session failed its check, None if
+    # it passed, or the exception if it couldn't be checked
+    def restored_check_done(self, filename, reason):
+        self.unchecked.discard(filename)
+        name = os.path.basename(filename)
+        if isinstance(reason, Exception):
+            # it is left in the session, ctt checks it again anyway
+            traceback.print_exception(type(reason), reason, reason.__traceback__)
+            reason = None
+        if reason is None:
+            self.prepare_process.add(filename)
+        else:
+            try:
+                session_manifest.reject(filename)
+            except Exception:
+                traceback.print_exc()
+            entry = session_manifest.capture_info(name)
+            if entry["kind"] == "macbeth" and name in self.list_of_files:
+                self.list_of_files.remove(name)
+                self.macbeth_used.remove(entry["temperature"])
+                self.listWidget_macbeth.clear()
+                self.listWidget_macbeth.addItems(self.list_of_files)
+            elif entry["kind"] == "alsc":
+                for item in self.listWidget_shading.findItems(name, Qt.MatchExactly):
+                    self.listWidget_shading.takeItem(self.listWidget_shading.row(item))
+                    self.alsc_used.remove(entry["temperature"])
+            self.rejected.append(name + ": " + reason)
+        self.update_buttons()
+        if not self.unchecked and self.rejected:
+            dialogue = QMessageBox()
+            dialogue.setWindowTitle("ERROR")
+            dialogue.setText("These captures from the earlier session failed their checks and have been moved to "
+                             + os.path.join(folder_directory, session_manifest.rejected_name)
+                             + ". Please take them again.\n\n" + "\n".join(self.rejected))
+            self.rejected = []
+            dialogue.exec()
+
+    # Grey out if input is not in good form. Called whenever any of the state
+    # it looks at changes: the text fields, the preview's exposure, captures
+    # starting and finishing, the session being restored and ctt.
+    def update_buttons(self):
+        macbeth_problem, alsc_problem, cac_problem = self.qpicamera2.problems
+        if self.ctt_running or self.restoring:
+            for button in (self.button_tab1, self.button_tab2, self.button_tab3,
+                           self.button_tab1_1, self.button_tab2_1, self.button_tab3_1):
+                button.setDisabled(True)
+            return
         if self.macbeth_bool:
             self.button_tab1.setDisabled(True)
-        elif self.temperature_tab1.text().isdigit() and self.lux_tab1.text().isdigit():
+        elif self.temperature_tab1.text().isdigit() and self.lux_tab1.text().isdigit() and not macbeth_problem:
             self.button_tab1.setDisabled(False)
         else:
             self.button_tab1.setDisabled(True)
+        if not self.macbeth_bool:
+            self.button_tab1.setText(macbeth_problem or "Click to capture Photo")
 
         # lens shading tab
-        if self.temperature_tab2.text().isdigit():
+        if self.temperature_tab2.text().isdigit() and len(self.writing) < max_pending_writes and not alsc_problem:
             self.button_tab2.setDisabled(False)
         else:
             self.button_tab2.setDisabled(True)
+        self.button_tab2.setText(alsc_problem or "Click to capture Photo")
 
-        if len(self.macbeth_used) < 2 or len(self.alsc_used) == 0 or self.macbeth_bool:
+        # cac tab
+        self.button_tab3.setDisabled(len(self.writing) >= max_pending_writes or cac_problem is not None)
+        self.button_tab3.setText(cac_problem or "Click to capture Photo")
+
+        # the camera takes one burst at a time
+        if busy:
+            for button in (self.button_tab1, self.button_tab2, self.button_tab3):
+                button.setDisabled(True)
+
+        if len(self.macbeth_used) < 2 or len(self.alsc_used) == 0 or self.macbeth_bool or self.writing or self.unchecked:
             self.button_tab1_1.setDisabled(True)
             self.button_tab2_1.setDisabled(True)
             self.button_tab3_1.setDisabled(True)
@@ -463,9 +1472,8 @@ class MyTabWidget(QWidget):
     # Creating the function that connects to button click
     def on_button_clicked(self):
 
-        global folder_directory, busy
+        global folder_directory
         # figure out which tab it is
-        busy = True
         self.overlay_active = overlay_active
         if self.tabs.currentIndex() == 0 and not self.macbeth_bool:
             if self.temperature_tab1.text() in self.macbeth_used:
@@ -473,34 +1481,20 @@ class MyTabWidget(QWidget):
                 msg.setText("Are you sure you want to overwrite image for this temperature?")
                 msg.setStandardButtons(QMessageBox.Ok | QMessageBox.Cancel)
                 ret = msg.exec()
-                if ret == QMessageBox.Ok:
-                    # macbeth procedure
-                    self.button_tab1.setText("Wait while detecting chart")
-                    self.button_tab1.setDisabled(True)
-                    temperature_value = self.temperature_tab1.text()
-                    lux_value = self.lux_tab1.text()
-                    self.macbeth_bool = True
-                    self.macbeth_used.append(temperature_value)
-                    # now we know that both of the values are intergers and macbeth plot is suppost to be in the picture
-                    filename = folder_directory + "/" + temperature_value + "K_" + lux_value + "L" + ".dng"
-                    self.list_of_files.append(temperature_value + "K_" + lux_value + "L" + ".dng")
-                    cfg = picam2.create_still_configuration()
-                    picam2.switch_mode_and_capture_file(cfg, filename, signal_function=self.qpicamera2.signal_done, name="raw")
-                else:
-                    pass
-            else:
-                # macbeth procedure
-                self.button_tab1.setText("Wait while detecting chart")
-                self.button_tab1.setDisabled(True)
-                temperature_value = self.temperature_tab1.text()
-                lux_value = self.lux_tab1.text()
-                self.macbeth_bool = True
-                self.macbeth_used.append(temperature_value)
-                # now we know that both of the values are intergers and macbeth plot is suppost to be in the picture
-                filename = folder_directory + "/" + temperature_value + "K_" + lux_value + "L" + ".dng"
-                self.list_of_files.append(temperature_value + "K_" + lux_value + "L" + ".dng")
-                cfg = picam2.create_still_configuration()
-                picam2.switch_mode_and_capture_file(cfg, filename, signal_function=self.qpicamera2.signal_done, name="raw")
+                if ret != QMessageBox.Ok:
+                    return
+            # macbeth procedure
+            self.button_tab1.setText("Wait while detecting chart")
+            self.button_tab1.setDisabled(True)
+            temperature_value = self.temperature_tab1.text()
+            lux_value = self.lux_tab1.text()
+            self.macbeth_bool = True
+            self.macbeth_used.append(temperature_value)
+            # now we know that both of the values are intergers and macbeth plot is suppost to be in the picture
+            filename = folder_directory + "/" + temperature_value + "K_" + lux_value + "L" + ".dng"
+            self.list_of_files.append(temperature_value + "K_" + lux_value + "L" + ".dng")
+            self.listWidget_macbeth.addItem(temperature_value + "K_" + lux_value + "L" + ".dng (checking)")
+            self.start_capture(filename, "macbeth", (temperature_value, lux_value, filename, self.overlay_active))
 
         elif self.tabs.currentIndex() == 1:
             # shading procedure
@@ -508,35 +1502,106 @@ class MyTabWidget(QWidget):
             self.alsc_used.append(temperature_value)
             index = self.alsc_used.count(temperature_value)
             filename = folder_directory + "/alsc_" + temperature_value + "K_" + str(index) + ".dng"
+            # a reopened session may have gaps in its numbering
+            while os.path.exists(filename) or filename in self.writing:
+                index += 1
+                filename = folder_directory + "/alsc_" + temperature_value + "K_" + str(index) + ".dng"
             # update the lists
-            listWidgetItem_shading = QListWidgetItem("alsc_" + temperature_value + "K_" + str(index) + ".dng")
+            listWidgetItem_shading = QListWidgetItem("alsc_" + temperature_value + "K_" + str(index) + ".dng (writing)")
             self.listWidget_shading.addItem(listWidgetItem_shading)
+            self.writing[filename] = (listWidgetItem_shading, temperature_value)
             self.button_tab2.setEnabled(False)
-            cfg = picam2.create_still_configuration()
-            picam2.switch_mode_and_capture_file(cfg, filename, signal_function=self.qpicamera2.signal_done, name="raw")
+            self.start_capture(filename, "alsc")
 
-        else:
+        elif self.tabs.currentIndex() == 2:
             # cac procedure
             self.cac_used += 1
             filename = folder_directory + "/cac_chart" + str(self.cac_used) + ".dng"
             self.button_tab3.setEnabled(False)
-            cfg = picam2.create_still_configuration()
-            picam2.switch_mode_and_capture_file(cfg, filename, signal_function=self.qpicamera2.signal_done, name="raw")
+            self.writing[filename] = (None, None)
+            self.start_capture(filename, "cac")
+        self.update_buttons()
+
+    # pauses the preview and takes a burst of raw frames for the still. Macbeth
+    # stills are kept in memory and remembered so that they can be checked
+    # before anything is written.
+    def start_capture(self, filename, kind, macbeth_capture=None):
+        global busy
+        busy = True
+        self.pending_captures.append((filename, macbeth_capture, timeline.now()))
+        cfg = picam2.create_still_configuration()
+        capture_burst(cfg, kind, self.qpicamera2.signal_done)
 
-    # Continues the video and checks for macbeth plot in machbet
-    def capture_done(self):
-        global folder_directory, busy
+    # Continues the video and checks or writes the still in the background
+    def capture_done(self, job):
+        global busy
+        busy = False
+        self.qpicamera2.resume()
+        self.update_buttons()
+        filename, macbeth_capture, start = self.pending_captures.pop(0)
+        timeline.record("still capture", start, kind=capture_kind(filename))
+        try:
+            burst = job.get_result()
+        except Exception as e:
+            if macbeth_capture is not None:
+                self.check_done(macbeth_capture, False, ("take", e))
+            else:
+                traceback.print_exc()
+                self.saved(filename, e)
+            return
+        if macbeth_capture is not None:
+            future = check_pool.submit(check_and_write, burst, filename)
+            future.add_done_callback(lambda f: self.check_signal.emit(macbeth_capture, *f.result()))
+        else:
+            future = write_pool.submit(save_still, burst, filename)
+            future.add_done_callback(lambda f: self.saved_signal.emit(filename, f.exception() or f.result()))
+
+    # Lens shading and cac stills are analysed once they are safely on disk.
+    # error is why the still was rejected, or the exception writing it.
+    def saved(self, filename, error):
+        item, temperature_value = self.writing.pop(filename)
+        if error is not None and item is not None:
+            self.listWidget_shading.takeItem(self.listWidget_shading.row(item))
+            self.alsc_used.remove(temperature_value)
+        self.update_buttons()
+        if error is not None:
+            dialogue = QMessageBox()
+            dialogue.setWindowTitle("ERROR")
+            if isinstance(error, str):
+                dialogue.setText(os.path.basename(filename) + " was not saved: " + error + ". Please take it again.")
+            else:
+                dialogue.setText("Could not write " + os.path.basename(filename) + ": " + str(error))
+            dialogue.exec()
+            return
+        if item is not None:
+            item.setText(os.path.basename(filename))
+        self.prepare_process.add(filename)
+
+    # Called once the check of a macbeth capture has finished. failure is what
+    # went wrong, as ("take", "check" or "write", the exception), if anything did.
+    def check_done(self, macbeth_capture, passed, failure=None):
+        temperature_value, lux_value, filename, overlay_active = macbeth_capture
         self.button_tab1.setText("Click to capture Photo")
-        file_location = folder_directory + "/" + self.temperature_tab1.text() + "K_" + self.lux_tab1.text() + "L" + ".dng"
-        if self.macbeth_bool is True and check(file_location, target) is False:
+        if passed is False:
+            # nothing was written, so any earlier image for this temperature is still there
             self.macbeth_bool = False
-            if self.macbeth_used.count(self.temperature_tab1.text()) > 1:
-                self.list_of_files = list(dict.fromkeys(self.list_of_files))
-                self.list_of_files.remove(self.temperature_tab1.text() + "K_" + self.lux_tab1.text() + "L" + ".dng")
-            self.macbeth_used.remove(self.temperature_tab1.text())
-            os.remove(file_location)
+            self.list_of_files.remove(temperature_value + "K_" + lux_value + "L" + ".dng")
+            self.macbeth_used.remove(temperature_value)
+            self.update_buttons()
             # dialogue about bad macbeth
-            if self.overlay_active:
+            if failure is not None:
+                stage, error = failure
+                traceback.print_exception(type(error), error, error.__traceback__)
+                messages = {
+                    "take": "Could not take %s: %s. Please take it again.",
+                    "check": "Checking %s failed: %s. Nothing was written, please take it again.",
+                    "write": "Could not write %s: %s",
+                }
+                dialogue = QMessageBox()
+                dialogue.setWindowTitle("ERROR")
+                dialogue.setText(messages[stage] % (os.path.basename(filename), error))
+                dialogue.exec()
+            elif overlay_active:
                 dialogue = QMessageBox()
                 dialogue.setWindowTitle("ERROR")
                 dialogue.setText("Image is too dark, please fix the lighting.")
@@ -546,39 +1611,92 @@ class MyTabWidget(QWidget):
                 dialogue.setWindowTitle("ERROR")
                 dialogue.setText("Could not find macbeth chart in the image, please take the photo again.")
                 dialogue.exec()
-        elif self.macbeth_bool:
+        else:
             # update the lists
             self.list_of_files = list(dict.fromkeys(self.list_of_files))
             self.macbeth_bool = False
-            # Print ut the list of files we have thta conatin macbeth
+            self.update_buttons()
+            self.prepare_process.add(filename)
+        # Print ut the list of files we have thta conatin macbeth
         self.listWidget_macbeth.clear()
         self.listWidget_macbeth.addItems(self.list_of_files)
-        busy = False
+
+    # ctt does its own checks, so anything found here is only passed on
+    def prepared(self, filename, reason):
+        if reason is not None:
+            print("Background analysis of " + os.path.basename(filename) + ": " + reason)
+        write_pool.submit(record_analysis, filename, reason)
 
     # Finishes ctt and closes app
     def on_button1_clicked(self):
         self.button_tab1_1.setText("Running ctt")
         self.button_tab2_1.setText("Running ctt")
         self.button_tab3_1.setText("Running ctt")
-        self.button_tab1.setDisabled(True)
-        self.button_tab2.setDisabled(True)
-        self.button_tab3.setDisabled(True)
+        self.ctt_running = True
+        self.update_buttons()
         QTimer.singleShot(200, self.capture_done_1)
 
-    # final function that does ctt
+    # final function that does ctt, both targets run at the same time in their own processes
     def capture_done_1(self):
-        global folder_directory
-        # does ctt with files and is done, but only if the folder has at east one macbeth and other one
-        # firt pisp pi5 file
-        from ctt_pisp import grid_size, json_template
-        t = "pisp"
-        json_output_pi5 = os.path.join(folder_directory, 'calibration_file_pi5.json')
-        run_ctt(json_output_pi5, folder_directory, None, None, json_template, grid_size, t)
-        # second vc4 pi4 file
-        from ctt_vc4 import grid_size, json_template
-        t = "vc4"
-        json_output_pi4 = os.path.join(folder_directory, 'calibration_file_pi4.json')
-        run_ctt(json_output_pi4, folder_directory, None, None, json_template, grid_size, t)
+        self.ctt_cancelled = False
+        # anything not analysed yet is shared with the ctt workers through the cache
+        self.prepare_process.finish()
+        self.ctt_processes = [CttProcess(t, folder_directory, self) for t in ("pisp", "vc4")]
+        self.ctt_progress = QProgressDialog("Running ctt", "Cancel", 0, 100, self)
+        self.ctt_progress.setWindowTitle("Running ctt")
+        self.ctt_progress.setWindowModality(Qt.WindowModal)
+        self.ctt_progress.setMinimumDuration(0)
+        self.ctt_progress.setAutoClose(False)
+        self.ctt_progress.setAutoReset(False)
+        self.ctt_progress.canceled.connect(self.cancel_ctt)
+        for process in self.ctt_processes:
+            process.progress_signal.connect(self.ctt_update)
+            process.finished.connect(self.ctt_finished)
+            process.errorOccurred.connect(self.ctt_error)
+            process.start()
+        self.ctt_update()
+
+    # shows the stage each target has reached
+    def ctt_update(self):
+        if self.ctt_progress is None:
+            return
+        done = sum(process.step / process.steps for process in self.ctt_processes)
+        self.ctt_progress.setValue(int(100 * done / len(self.ctt_processes)))
+        self.ctt_progress.setLabelText("\n".join(process.target + ": " + process.stage for process in self.ctt_processes))
+
+    def cancel_ctt(self):
+        self.ctt_cancelled = True
+        for process in self.ctt_processes:
+            process.kill()
+
+    # a worker that never started doesn't emit finished
+    def ctt_error(self, error):
+        if error == QProcess.FailedToStart:
+            self.ctt_finished()
+
+    def ctt_finished(self, *args):
+        if self.ctt_progress is None or any(process.state() != QProcess.NotRunning for process in self.ctt_processes):
+            return
+        # closing the dialog emits canceled, so disconnect first
+        self.ctt_progress.canceled.disconnect(self.cancel_ctt)
+        self.ctt_progress.close()
+        self.ctt_progress = None
+        failed = [process.target for process in self.ctt_processes if process.failed()]
+        if self.ctt_cancelled or failed:
+            if not self.ctt_cancelled:
+                dialogue = QMessageBox()
+                dialogue.setWindowTitle("ERROR")
+                dialogue.setText("Ctt failed for " + " and ".join(failed) + ", see the terminal output for details.")
+                dialogue.exec()
+            # go back to taking pictures, the old worker has been told to stop
+            self.prepare_process = PrepareProcess(folder_directory, self)
+            self.prepare_process.prepared_signal.connect(self.prepared)
+            self.button_tab1_1.setText("Done")
+            self.button_tab2_1.setText("Done")
+            self.button_tab3_1.setText("Done")
+            self.ctt_running = False
+            self.update_buttons()
+            return
 
         # says that it has finished and written files in the folder_directory
         dialogue_done = QMessageBox()
@@ -591,8 +1709,35 @@ class MyTabWidget(QWidget):
         app.exit()
 
 
+# Tunes every connected camera at once, each in a process of its own with its
+# own preview, detection and session folder, so that one camera's work doesn't
+# hold up another's. The ctt runs of all of them share out the cores between
+# them, see ctt_worker.py.
+def tune_all_cameras(qt_args):
+    if replay_folder:
+        count = len(replay_folder.split(os.pathsep))
+    else:
+        from picamera2 import Picamera2
+        count = len(Picamera2.global_camera_info())
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--camera", str(n)] + qt_args)
+                 for n in range(count)]
+    try:
+        return max([process.wait() for process in processes], default=1)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+
+
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Take the captures to tune a camera and run ctt on them.")
+    parser.add_argument("--camera", default="0",
+                        help="number of the camera to tune, or all to tune every connected camera side by side")
+    args, qt_args = parser.parse_known_args()
+    if args.camera == "all":
+        sys.exit(tune_all_cameras(qt_args))
+    camera_num = int(args.camera)
+    app = QApplication(sys.argv[:1] + qt_args)
     execution_1 = FirstWindow()
     app.exec_()
     if start is True:
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# Validates and tunes a folder of captures that already exists, with no Qt and
+# no camera. Each DNG gets the same checks as in TuningApp, spread over a
+# process pool. Both ctt targets are then run side by side on the files that
+# passed. A JSON report says which files were rejected and why.
+#
+#   ./batch_tune.py ~/imx708_3 --report imx708_3.json
+import argparse
+import functools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from capture_checks import (capture_kind, check_file, peak_memory,
+                            quick_check_file)
+from ctt_worker import ctt_directory, json_outputs
+from session_cache import SessionCache, use_cache
+
+ctt_worker = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ctt_worker.py")
+
+
+# each checking process fills the folder's cache, which ctt then reads from
+def start_checker(folder):
+    sys.path.insert(1, ctt_directory)
+    use_cache(SessionCache(folder))
+
+
+def check_one(filename, quick=False):
+    start = time.monotonic()
+    reason, peak = peak_memory(quick_check_file if quick else check_file, filename)
+    return {
+        "file": os.path.basename(filename),
+        "kind": capture_kind(filename),
+        "accepted": reason is None,
+        "reason": reason,
+        "seconds": round(time.monotonic() - start, 3),
+        "peak_memory_mb": round(peak / 2**20, 1),
+    }
+
+
+# what the ctt run needs, as in the app: two macbeth images and one lens shading one
+def missing_captures(files):
+    accepted = [f["kind"] for f in files if f["accepted"]]
+    if accepted.count("macbeth") < 2:
+        return "at least two macbeth images are needed"
+    elif "alsc" not in accepted:
+        return "at least one lens shading image is needed"
+    return None
+
+
+# Runs both ctt targets at once through ctt_worker.py, passing their progress
+# on to stderr. Returns the exit code of each target.
+def run_ctt_targets(folder, output_directory):
+    processes = {
+        target: subprocess.Popen([sys.executable, ctt_worker, target, folder, "--output-dir", output_directory],
+                                 stdout=subprocess.PIPE, text=True)
+        for target in json_outputs
+    }
+
+    def forward(process):
+        for line in process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            print("%s: %s (%d/%d)" % (message["target"], message["stage"], message["step"], message["steps"]),
+                  file=sys.stderr)
+
+    readers = [threading.Thread(target=forward, args=(process,)) for process in processes.values()]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    return {target: process.wait() for target, process in processes.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate and tune an existing folder of tuning captures.")
+    parser.add_argument("folder", help="folder of *K_*L.dng, alsc_*.dng and cac_chart*.dng files")
+    parser.add_argument("--report", help="where to write the JSON report, batch_report.json in the folder by default")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of files to check at once")
+    parser.add_argument("--no-ctt", action="store_true", help="only check the files, don't run ctt")
+    parser.add_argument("--quick", action="store_true",
+                        help="check the files with the memory-mapped reader instead of ctt's, ctt then decodes them itself")
+    args = parser.parse_args()
+
+    folder = os.path.abspath(args.folder)
+    report_file = args.report or os.path.join(folder, "batch_report.json")
+    filenames = sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(".dng"))
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=start_checker, initargs=(folder,)) as pool:
+        files = list(pool.map(functools.partial(check_one, quick=args.quick), filenames))
+    for f in files:
+        if not f["accepted"]:
+            print("rejected " + f["file"] + ": " + f["reason"], file=sys.stderr)
+    report = {"folder": folder, "files": files, "ctt": None}
+
+    status = 0
+    missing = missing_captures(files)
+    if args.no_ctt:
+        pass
+    elif missing:
+        report["ctt"] = {"skipped": missing}
+        status = 2
+    else:
+        # ctt only gets to see the files that passed
+        rejected = [f for f in files if not f["accepted"]]
+        ctt_folder = tempfile.mkdtemp(prefix=".batch_", dir=folder) if rejected else folder
+        try:
+            if rejected:
+                for f in files:
+                    if f["accepted"]:
+                        os.symlink(os.path.join(folder, f["file"]), os.path.join(ctt_folder, f["file"]))
+            exit_codes = run_ctt_targets(ctt_folder, folder)
+        finally:
+            if rejected:
+                shutil.rmtree(ctt_folder)
+        report["ctt"] = {
+            target: {"exit_code": code, "output": os.path.join(folder, json_outputs[target]) if code == 0 else None}
+            for target, code in exit_codes.items()
+        }
+        if any(exit_codes.values()):
+            status = 1
+
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+    print("report written to " + report_file, file=sys.stderr)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
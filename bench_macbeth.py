@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+# Benchmarks the live chart detector without a camera or a chart. Frames are
+# made by warping ctt's reference chart, ctt_ref.pgm, onto a background at a
+# range of scales, perspectives, brightnesses and noise levels. The darker ones
+# can only be found after the gain 2 and 4 retries. Recorded frames can be added
+# too. The report gives throughput, latency percentiles, detection rate and
+# corner error, overall and for each setting. Compared against a saved baseline
+# it exits with 1 on a regression.
+#
+#   ./bench_macbeth.py --save-baseline macbeth_baseline.json
+#   ./bench_macbeth.py --baseline macbeth_baseline.json
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import TuningApp
+
+# the settings each synthetic frame is made with, every combination is used
+scales = (0.3, 0.5, 0.7)
+perspectives = (0.0, 0.1, 0.2)
+brightnesses = (1.0, 0.5, 0.25)
+noises = (0.0, 4.0, 12.0)
+
+
+# The chart from ref, (ref_h, ref_w) pixels, warped onto a size (w, h) frame.
+# scale is the chart's width as a fraction of the frame, perspective how far
+# each corner may move as a fraction of the chart, brightness scales the whole
+# frame and noise is the standard deviation of the noise added, in grey levels.
+# Returns the frame and where the chart's corners are, in ref_corns order.
+def render_frame(ref, size, scale, perspective, brightness, noise, rng):
+    w, h = size
+    cw = scale * w
+    ch = cw * TuningApp.ref_h / TuningApp.ref_w
+    angle = np.radians(rng.uniform(-10, 10))
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    corners = (TuningApp.ref_corns - (TuningApp.ref_w / 2, TuningApp.ref_h / 2)) * (cw / TuningApp.ref_w)
+    corners = corners @ rotation.T + rng.uniform(-perspective, perspective, (4, 2)) * (cw, ch)
+    # anywhere the whole chart still fits in the frame
+    low, high = -corners.min(axis=0), (w, h) - corners.max(axis=0)
+    corners = (corners + rng.uniform(low, np.maximum(low, high))).astype(np.float32)
+
+    cv2 = TuningApp.cv2
+    background = cv2.GaussianBlur(rng.normal(110, 40, (h, w)), (0, 0), 12) + rng.normal(0, 6, (h, w))
+    transform = cv2.getPerspectiveTransform(TuningApp.ref_corns, corners)
+    chart = cv2.warpPerspective(ref.astype(np.float32), transform, (w, h), flags=cv2.INTER_LINEAR)
+    mask = cv2.warpPerspective(np.ones(ref.shape, np.float32), transform, (w, h), flags=cv2.INTER_LINEAR)
+    frame = chart + (1 - mask) * background
+    frame = frame * brightness + rng.normal(0, noise, (h, w)) if noise else frame * brightness
+    return np.clip(np.round(frame), 0, 255).astype(np.uint8), corners
+
+
+def synthetic_frames(size, frames_per_case, seed):
+    rng = np.random.default_rng(seed)
+    ref = TuningApp.ref_data[0]
+    for scale, perspective, brightness, noise in itertools.product(scales, perspectives, brightnesses, noises):
+        settings = {"scale": scale, "perspective": perspective, "brightness": brightness, "noise": noise}
+        for _ in range(frames_per_case):
+            frame, corners = render_frame(ref, size, scale, perspective, brightness, noise, rng)
+            yield settings, frame, corners
+
+
+# Recorded frames are 8 bit greyscale images (.png, .pgm) or arrays (.npy) in a
+# folder. A corners.json there, mapping a file name to its four corners, gives
+# the corner error for those frames.
+def recorded_frames(folder):
+    corners_file = os.path.join(folder, "corners.json")
+    truth = {}
+    if os.path.exists(corners_file):
+        with open(corners_file) as f:
+            truth = json.load(f)
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if name.endswith(".npy"):
+            frame = np.load(path)
+        elif name.endswith((".png", ".pgm")):
+            frame = TuningApp.cv2.imread(path, flags=TuningApp.cv2.IMREAD_GRAYSCALE)
+        else:
+            continue
+        corners = np.array(truth[name], np.float32) if name in truth else None
+        yield {"recorded": name}, np.ascontiguousarray(frame), corners
+
+
+# the mean distance between matching corners, whichever corner the detector starts from
+def corner_error(found, corners):
+    errors = []
+    for order in (found, found[::-1]):
+        for shift in range(4):
+            errors.append(np.linalg.norm(np.roll(order, shift, axis=0) - corners, axis=1).mean())
+    return float(min(errors))
+
+
+def detect_chart(frame):
+    cor, _, coords, _ = TuningApp.find_macbeth_at_gain(frame, 1)
+    if cor > 0.5:
+        return (cor, np.asarray(coords[0], dtype=np.float32).reshape(4, 2))
+    return (0, None)
+
+
+detectors = {"find": TuningApp.my_find_macbeth, "chart": detect_chart}
+
+
+def run_one(detect, settings, frame, corners):
+    # each frame is searched as if it was the first, starting at gain 1
+    TuningApp.last_gain = 1
+    start = time.perf_counter()
+    cor, quad = detect(frame)
+    seconds = time.perf_counter() - start
+    return {
+        "settings": settings,
+        "seconds": seconds,
+        "found": quad is not None,
+        "gain": TuningApp.last_gain if quad is not None else None,
+        "error": corner_error(quad, corners) if quad is not None and corners is not None else None,
+    }
+
+
+def summarise(results, wall_seconds=None):
+    latencies = np.array([r["seconds"] for r in results]) * 1000
+    errors = [r["error"] for r in results if r["error"] is not None]
+    summary = {
+        "frames": len(results),
+        "detection_rate": round(sum(r["found"] for r in results) / len(results), 4),
+        "latency_p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "latency_p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        "latency_p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        "corner_error_px": round(float(np.mean(errors)), 2) if errors else None,
+        "gains": {str(g): sum(r["gain"] == g for r in results) for g in TuningApp.macbeth_gains},
+    }
+    if wall_seconds:
+        summary["frames_per_second"] = round(len(results) / wall_seconds, 2)
+    return summary
+
+
+# Regressions against the baseline's overall results, as a list of messages
+def regressions(overall, baseline, max_slowdown, max_rate_drop, max_error_increase):
+    found = []
+    if overall["detection_rate"] < baseline["detection_rate"] - max_rate_drop:
+        found.append("detection rate %.3f, was %.3f" % (overall["detection_rate"], baseline["detection_rate"]))
+    if overall["latency_p95_ms"] > baseline["latency_p95_ms"] * max_slowdown:
+        found.append("p95 latency %.1f ms, was %.1f ms" % (overall["latency_p95_ms"], baseline["latency_p95_ms"]))
+    if overall.get("frames_per_second") and baseline.get("frames_per_second") and \
+            overall["frames_per_second"] < baseline["frames_per_second"] / max_slowdown:
+        found.append("throughput %.1f fps, was %.1f fps" % (overall["frames_per_second"], baseline["frames_per_second"]))
+    if overall["corner_error_px"] is not None and baseline.get("corner_error_px") is not None and \
+            overall["corner_error_px"] > baseline["corner_error_px"] + max_error_increase:
+        found.append("corner error %.2f px, was %.2f px" % (overall["corner_error_px"], baseline["corner_error_px"]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Macbeth chart detector on synthetic and recorded frames.")
+    parser.add_argument("--detector", choices=sorted(detectors), default="find",
+                        help="find: the live search with gain retries, chart: one get_macbeth_chart call")
+    parser.add_argument("--target", choices=("pi4", "pi5"), default="pi5", help="which ctt json template to load")
+    parser.add_argument("--size", type=int, nargs=2, default=TuningApp.lores_size or TuningApp.main["size"],
+                        metavar=("WIDTH", "HEIGHT"), help="size of the synthetic frames")
+    parser.add_argument("--frames-per-case", type=int, default=3, help="synthetic frames for each combination of settings")
+    parser.add_argument("--no-synthetic", action="store_true", help="only use recorded frames")
+    parser.add_argument("--recorded", help="folder of recorded frames to add")
+    parser.add_argument("--in-flight", type=int, default=TuningApp.detections_in_flight,
+                        help="frames detected at the same time, as in the live preview")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", help="where to write the JSON report")
+    parser.add_argument("--baseline", help="report to compare against, regressions make the exit code 1")
+    parser.add_argument("--save-baseline", help="also write the report here, to compare later runs against")
+    parser.add_argument("--max-slowdown", type=float, default=1.25, help="allowed latency and throughput ratio")
+    parser.add_argument("--max-rate-drop", type=float, default=0.02, help="allowed drop in detection rate")
+    parser.add_argument("--max-error-increase", type=float, default=1.0, help="allowed increase in corner error, pixels")
+    args = parser.parse_args()
+
+    TuningApp.target = args.target
+    TuningApp.load_ctt()
+    detect = detectors[args.detector]
+    frames = []
+    if not args.no_synthetic:
+        frames += list(synthetic_frames(tuple(args.size), args.frames_per_case, args.seed))
+    if args.recorded:
+        frames += list(recorded_frames(args.recorded))
+    if not frames:
+        parser.error("no frames to benchmark")
+
+    # once so that nothing is timed while it warms up
+    run_one(detect, *frames[0])
+    # latency, detection and the gain that found the chart are measured one frame at a time
+    results = [run_one(detect, *frame) for frame in frames]
+    # throughput with several frames being searched at once, as in the preview
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.in_flight) as executor:
+        list(executor.map(lambda frame: detect(frame[1]), frames))
+    wall_seconds = time.perf_counter() - start
+
+    report = {"detector": args.detector, "in_flight": args.in_flight, "overall": summarise(results, wall_seconds),
+              "by_setting": {}}
+    for name in ("scale", "perspective", "brightness", "noise"):
+        values = sorted({r["settings"][name] for r in results if name in r["settings"]})
+        report["by_setting"][name] = {
+            str(value): summarise([r for r in results if r["settings"].get(name) == value]) for value in values
+        }
+    recorded = [r for r in results if "recorded" in r["settings"]]
+    if recorded:
+        report["by_setting"]["recorded"] = {"all": summarise(recorded)}
+
+    overall = report["overall"]
+    print("%d frames, %.1f frames/s, detected %.1f%%, latency p50 %.1f ms p95 %.1f ms p99 %.1f ms, corner error %s px" % (
+        overall["frames"], overall["frames_per_second"], 100 * overall["detection_rate"], overall["latency_p50_ms"],
+        overall["latency_p95_ms"], overall["latency_p99_ms"], overall["corner_error_px"]))
+    for name, groups in report["by_setting"].items():
+        for value, summary in groups.items():
+            print("  %-12s %-6s detected %5.1f%%, p95 %6.1f ms, corner error %s px, gains %s" % (
+                name, value, 100 * summary["detection_rate"], summary["latency_p95_ms"], summary["corner_error_px"],
+                summary["gains"]))
+
+    for path in (args.report, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["overall"]
+        found = regressions(overall, baseline, args.max_slowdown, args.max_rate_drop, args.max_error_increase)
+        for message in found:
+            print("REGRESSION: " + message, file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
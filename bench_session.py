@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+# Runs the whole app against the replay camera, with no camera and no display,
+# and measures it: how long from a preview frame arriving to the overlay showing
+# where the chart is, how long each kind of still takes from the click until it
+# has been checked and written, and how much CPU all of that uses.
+#
+#   ./bench_session.py ~/imx708_1 --macbeth 3 --alsc 2 --report session.json
+#
+# The folder is replayed as described in replay_camera.py. The captures go to a
+# temporary folder, or to --output, which carries on the session there if any.
+# Each capture button is also clicked a second time during its burst, and if
+# that starts another burst the exit code is 1.
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+def cpu_seconds(who=resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentiles(seconds):
+    if not seconds:
+        return {"count": 0}
+    ms = np.array(seconds) * 1000
+    return {"count": len(seconds), "p50_ms": round(float(np.percentile(ms, 50)), 1),
+            "p95_ms": round(float(np.percentile(ms, 95)), 1), "max_ms": round(float(ms.max()), 1)}
+
+
+# Drives the app through a script, a generator that yields a number of seconds
+# to wait or a function to wait until it returns true. A dialog opened by the
+# script runs the event loop again inside it, so it isn't stepped again until
+# the dialog has gone.
+class Driver:
+    def __init__(self, script, poll_ms=20):
+        from PyQt5.QtCore import QTimer
+        self.script = script
+        self.waiting = lambda: True
+        self.stepping = False
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.step)
+        self.timer.start(poll_ms)
+
+    def step(self):
+        if self.stepping or not self.waiting():
+            return
+        self.stepping = True
+        try:
+            wait = next(self.script)
+        except StopIteration:
+            self.timer.stop()
+            return
+        finally:
+            self.stepping = False
+        if callable(wait):
+            self.waiting = wait
+        else:
+            until = time.monotonic() + wait
+            self.waiting = lambda: time.monotonic() >= until
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the tuning app end to end against a replayed session.")
+    parser.add_argument("folder", help="session folder to replay, see replay_camera.py")
+    parser.add_argument("--output", help="session folder for the captures, a temporary one by default")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of preview before measuring")
+    parser.add_argument("--seconds", type=float, default=10, help="seconds of preview to measure")
+    parser.add_argument("--macbeth", type=int, default=2, help="macbeth stills to take")
+    parser.add_argument("--alsc", type=int, default=1, help="lens shading stills to take")
+    parser.add_argument("--cac", type=int, default=0, help="cac stills to take")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for each still")
+    parser.add_argument("--ctt", action="store_true", help="press Done at the end and time the ctt run")
+    parser.add_argument("--report", help="where to write the JSON report")
+    args = parser.parse_args()
+
+    # both are read when the app is imported
+    os.environ["TUNING_REPLAY"] = os.path.abspath(os.path.expanduser(args.folder))
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtCore import QTimer
+    from PyQt5.QtWidgets import QApplication, QMessageBox
+
+    import TuningApp
+
+    output = args.output or os.path.join(tempfile.mkdtemp(prefix="bench_session_"), "session")
+    os.makedirs(output, exist_ok=True)
+    TuningApp.folder_directory = output
+    app = QApplication(sys.argv)
+    TuningApp.app = app
+    start = time.monotonic()
+    TuningApp.load_camera(lambda folder: None)
+    TuningApp.session_manifest.start(output, TuningApp.camera_model, TuningApp.target)
+    window = TuningApp.App()
+    tabs = window.tab_widget
+    preview = tabs.qpicamera2
+
+    # every detection result, and every still as it is checked or written
+    results = []
+    preview.scheduler.result_signal.connect(
+        lambda array, result, arrived: results.append((time.monotonic() - arrived, result[1] is not None)))
+    finished = {}
+    tabs.check_signal.connect(lambda capture, passed, failure: finished.setdefault(
+        capture[2], (time.monotonic(), "%s failed: %s" % failure if failure else passed)))
+    tabs.saved_signal.connect(lambda filename, error: finished.setdefault(filename, (time.monotonic(), error)))
+    # dialogs would wait for a click that never comes, so they are noted and closed
+    dialogs = []
+
+    def close_dialogs():
+        dialogue = QApplication.activeModalWidget()
+        if isinstance(dialogue, QMessageBox):
+            dialogs.append(dialogue.text())
+            dialogue.done(QMessageBox.Ok)
+
+    dialog_timer = QTimer()
+    dialog_timer.timeout.connect(close_dialogs)
+    dialog_timer.start(100)
+
+    report = {"folder": args.folder, "startup_seconds": round(time.monotonic() - start, 2), "captures": [], "errors": []}
+
+    # the macbeth file name is known beforehand, the others are numbered by the app
+    def take(kind, button, fields, filename=None):
+        tabs.tabs.setCurrentIndex({"macbeth": 0, "alsc": 1, "cac": 2}[kind])
+        for field, text in fields:
+            field.setText(text)
+        deadline = time.monotonic() + args.timeout
+        yield lambda: button.isEnabled() or time.monotonic() > deadline
+        capture = {"kind": kind}
+        report["captures"].append(capture)
+        if not button.isEnabled():
+            capture["result"] = "not allowed: " + button.text()
+            return
+        clicked = time.monotonic()
+        cpu = cpu_seconds()
+        writing = set(tabs.writing)
+        button.click()
+        filename = filename or (set(tabs.writing) - writing).pop()
+        # A second click during the burst must not start another one, even once
+        # something else has had the buttons updated
+        pending = len(tabs.pending_captures)
+        tabs.update_buttons()
+        button.click()
+        if len(tabs.pending_captures) > pending:
+            report["errors"].append("a second click started another %s burst" % kind)
+        capture["file"] = os.path.basename(filename)
+        yield lambda: filename in finished or time.monotonic() > deadline
+        if filename not in finished:
+            capture["result"] = "timed out"
+            return
+        done, result = finished[filename]
+        capture["seconds"] = round(done - clicked, 3)
+        capture["cpu_seconds"] = round(cpu_seconds() - cpu, 3)
+        capture["result"] = "ok" if result is True or result is None else "rejected: " + str(result)
+
+    def script():
+        yield args.warmup
+        first, frame_count, cpu = len(results), len(preview_frames), cpu_seconds()
+        started = time.monotonic()
+        yield args.seconds
+        seconds = time.monotonic() - started
+        measured = results[first:]
+        report["preview"] = {
+            "seconds": round(seconds, 2),
+            "fps": round((len(preview_frames) - frame_count) / seconds, 2),
+            "detections_per_second": round(len(measured) / seconds, 2),
+            "found_fraction": round(sum(found for _, found in measured) / max(len(measured), 1), 3),
+            "frame_to_overlay": percentiles([latency for latency, _ in measured]),
+            "dropped_frames": preview.scheduler.dropped,
+            "cpu_percent": round(100 * (cpu_seconds() - cpu) / seconds, 1),
+        }
+
+        for i in range(args.macbeth):
+            temperature = str(3000 + 500 * i)
+            yield from take("macbeth", tabs.button_tab1, [(tabs.temperature_tab1, temperature), (tabs.lux_tab1, "1000")],
+                            os.path.join(output, temperature + "K_1000L.dng"))
+        for _ in range(args.alsc):
+            yield from take("alsc", tabs.button_tab2, [(tabs.temperature_tab2, "3000")])
+        for _ in range(args.cac):
+            yield from take("cac", tabs.button_tab3, [])
+        yield lambda: not tabs.writing
+
+        if args.ctt:
+            # Done needs two macbeth stills and a lens shading one
+            deadline = time.monotonic() + args.timeout
+            yield lambda: tabs.button_tab1_1.isEnabled() or time.monotonic() > deadline
+            if tabs.button_tab1_1.isEnabled():
+                ctt_clicked.append(time.monotonic())
+                tabs.button_tab1_1.click()
+                yield 0.5
+                # a successful run closes the app itself, a failed one goes back to capturing
+                yield lambda: not tabs.ctt_running
+        app.exit()
+
+    ctt_clicked = []
+    preview_frames = []
+    preview.qpicamera2.done_signal.connect(lambda job: preview_frames.append(time.monotonic()))
+    wall, cpu = time.monotonic(), cpu_seconds()
+    driver = Driver(script())
+    app.exec_()
+    driver.timer.stop()
+    dialog_timer.stop()
+    TuningApp.picam2.stop()
+    # the background analysis finishes what it was given, so its CPU time is counted
+    tabs.prepare_process.finish()
+    tabs.prepare_process.waitForFinished(-1)
+    TuningApp.timeline.save()
+    if args.ctt:
+        report["ctt_seconds"] = round(time.monotonic() - ctt_clicked[0], 2) if ctt_clicked else None
+    report["cpu_percent"] = round(100 * (cpu_seconds() - cpu) / (time.monotonic() - wall), 1)
+    report["child_cpu_seconds"] = round(cpu_seconds(resource.RUSAGE_CHILDREN), 2)
+    for kind in ("macbeth", "alsc", "cac"):
+        seconds = [c["seconds"] for c in report["captures"] if c["kind"] == kind and "seconds" in c]
+        if seconds:
+            report.setdefault("turnaround", {})[kind] = percentiles(seconds)
+    report["dialogs"] = dialogs
+
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    if not args.output:
+        shutil.rmtree(os.path.dirname(output))
+    for error in report["errors"]:
+        print("ERROR: " + error, file=sys.stderr)
+    if report["errors"]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
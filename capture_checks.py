@@ -0,0 +1,235 @@
+# Checks on captured DNG files that need neither Qt nor a camera, shared by
+# TuningApp and batch_tune.py.
+import os
+import re
+import sys
+import tracemalloc
+
+import numpy as np
+
+from ctt_worker import ctt_directory
+from dng_reader import DngRaw, chunk_rows
+
+# the kinds of capture ctt knows about, from the file name
+macbeth_name = re.compile(r"\d+[kK].*\d+[lL]\.dng$")
+
+
+def capture_kind(name):
+    name = os.path.basename(name)
+    if not name.lower().endswith(".dng"):
+        return None
+    elif name.startswith("alsc_"):
+        return "alsc"
+    elif name.startswith("cac"):
+        return "cac"
+    elif macbeth_name.search(name):
+        return "macbeth"
+    return None
+
+
+# Loads a DNG the way ctt does and checks it is bright enough and, for macbeth
+# captures, that the chart can be found. Returns None if it is fine, otherwise
+# the reason it was rejected.
+def check_file(filename, json_template=None):
+    if ctt_directory not in sys.path:
+        sys.path.insert(1, ctt_directory)
+    from ctt import Camera
+    from ctt_image_load import dng_load_image
+    from ctt_macbeth_locator import find_macbeth
+    if json_template is None:
+        from ctt_pisp import json_template
+
+    kind = capture_kind(filename)
+    if kind is None:
+        return "unrecognised file name"
+    Cam = Camera("imx.json", json=json_template)
+    try:
+        Img = dng_load_image(Cam, filename)
+    except Exception as e:
+        return "could not be loaded: " + str(e)
+
+    av_chan = (np.mean(np.array(Img.channels), axis=0) / (2 ** 16))
+    av_val = np.mean(av_chan)
+    if av_val < Img.blacklevel_16 / (2**16) + 1 / 64:
+        return "too dark"
+    if kind == "macbeth" and find_macbeth(Cam, av_chan, mac_config=(0, 0)) is None:
+        return "no macbeth chart found"
+    if kind == "cac":
+        step = max(1, av_chan.shape[1] // cac_check_width)
+        return cac_check(av_chan[::step, ::step], Img.blacklevel_16 / (2**16))
+    return None
+
+
+# The same checks for validation only, reading the DNG through DngRaw one
+# Bayer quad in every step in each direction. Nothing the size of the image is
+# ever made, but nothing is left in the cache for ctt either.
+def quick_check_file(filename, json_template=None, step=2):
+    kind = capture_kind(filename)
+    if kind is None:
+        return "unrecognised file name"
+    try:
+        with DngRaw(filename) as raw:
+            av_chan = raw.quad_means(step)
+            black_level = raw.black_level
+            scale = 2 ** raw.bit_depth
+    except Exception as e:
+        return "could not be loaded: " + str(e)
+
+    av_chan *= 1 / scale
+    if av_chan.mean() < black_level / scale + 1 / 64:
+        return "too dark"
+    if kind == "macbeth":
+        if ctt_directory not in sys.path:
+            sys.path.insert(1, ctt_directory)
+        from ctt import Camera
+        from ctt_macbeth_locator import find_macbeth
+        if json_template is None:
+            from ctt_pisp import json_template
+        Cam = Camera("imx.json", json=json_template)
+        if find_macbeth(Cam, av_chan, mac_config=(0, 0)) is None:
+            return "no macbeth chart found"
+    if kind == "cac":
+        step = max(1, av_chan.shape[1] // cac_check_width)
+        return cac_check(av_chan[::step, ::step], black_level / scale)
+    return None
+
+
+# CAC charts are a grid of dark dots on a light background. They are found as
+# the connected patches darker than their surroundings that are round, about
+# the size of the other dots and clear of the edges. All of it works on whole
+# arrays, so a 640x480 preview frame takes around ten milliseconds.
+#
+# cells of the grid the coverage is worked out over, (columns, rows)
+cac_grid = (8, 6)
+# what a usable chart looks like: this many dots, over this fraction of the
+# cells, and sharp enough. Sharpness is 1 / (1 + the blur of the dots' edges,
+# as a Gaussian sigma in pixels), so 0.3 allows a blur of about 2.3 pixels.
+min_cac_dots = 20
+min_cac_coverage = 0.75
+min_cac_sharpness = 0.3
+# sigma of the blur added to measure the one already there
+cac_reblur = 1.0
+# Dots blurred by more than about their radius have no edges left to measure,
+# but their middles are no longer dark either. Those less than this much darker
+# than their surroundings don't count as sharp.
+min_cac_depth = 0.4
+# how much darker than the local mean, in grey levels, a dot has to be
+cac_threshold = 12
+# saved stills are checked at about this width, as the preview is
+cac_check_width = 1000
+
+
+# The dots in an 8 bit image, as their centres, the fraction of cac_grid cells
+# with a dot in and the sharpness of the dots' edges, and a flag for each cell:
+# 0 where it is fine, 1 where there are no dots and 2 where they are blurred.
+def find_dot_grid(image):
+    import cv2
+    h, w = image.shape
+    columns, rows = cac_grid
+    block = max(w // 16, 3) | 1
+    dark = cv2.adaptiveThreshold(image, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, block, cac_threshold)
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(dark, connectivity=8)
+    x, y, bw, bh, area = stats[1:].T
+    # a disc fills about pi / 4 of its bounding box
+    fill = area / (bw * bh)
+    keep = (area >= 6) & (area <= h * w / (4 * columns * rows)) & (fill > 0.6) & (fill < 0.95)
+    keep &= (bw <= 1.5 * bh) & (bh <= 1.5 * bw) & (x > 0) & (y > 0) & (x + bw < w) & (y + bh < h)
+    if keep.any():
+        median = np.median(area[keep])
+        keep &= (area > median / 3) & (area < median * 3)
+    dots = centroids[1:][keep]
+    if len(dots) < min_cac_dots:
+        return dots, 0.0, 0.0, np.ones((rows, columns), dtype=np.uint8)
+
+    # The blur of the dots' edges, from how much a further blur of known width
+    # flattens them. An edge blurred by sigma keeps sigma / sqrt(sigma^2 + b^2)
+    # of its slope after a blur of b, whatever its contrast. Only the middle
+    # of each edge, where it is steepest, is measured.
+    is_dot = np.zeros(count, dtype=np.uint8)
+    is_dot[1:][keep] = 1
+    mask = is_dot[labels]
+    kernel = np.ones((3, 3), dtype=np.uint8)
+    band_y, band_x = np.nonzero(cv2.dilate(mask, kernel) - cv2.erode(mask, kernel))
+    image = image.astype(np.float32)
+    centre_x = np.clip(np.round(dots[:, 0]).astype(int), 0, w - 1)
+    centre_y = np.clip(np.round(dots[:, 1]).astype(int), 0, h - 1)
+    surroundings = cv2.blur(image, (block, block))[centre_y, centre_x]
+    deep = image[centre_y, centre_x] < (1 - min_cac_depth) * surroundings
+    slope = cv2.magnitude(cv2.Sobel(image, cv2.CV_32F, 1, 0), cv2.Sobel(image, cv2.CV_32F, 0, 1))[band_y, band_x]
+    reblurred = cv2.GaussianBlur(image, (0, 0), cac_reblur)
+    slope_reblurred = cv2.magnitude(cv2.Sobel(reblurred, cv2.CV_32F, 1, 0), cv2.Sobel(reblurred, cv2.CV_32F, 0, 1))
+    slope_reblurred = slope_reblurred[band_y, band_x]
+    steep = slope_reblurred > np.median(slope_reblurred)
+    band_x, band_y = band_x[steep], band_y[steep]
+    ratio = np.clip(slope[steep] / slope_reblurred[steep], 1.01, 10)
+
+    def sharpness_of(ratio):
+        return 1 / (1 + cac_reblur / np.sqrt(ratio ** 2 - 1))
+
+    # the dots and the edges in each cell
+    def cell_of(px, py):
+        return (py * rows // h) * columns + px * columns // w
+
+    dot_cells = cell_of(dots[:, 0].astype(int), dots[:, 1].astype(int))
+    covered = np.bincount(dot_cells, minlength=rows * columns) > 0
+    edge_cells = cell_of(band_x, band_y)
+    edge_pixels = np.bincount(edge_cells, minlength=rows * columns)
+    cell_ratio = np.bincount(edge_cells, ratio, rows * columns) / np.maximum(edge_pixels, 1)
+    sharpness = float(sharpness_of(np.median(ratio)) * deep.mean())
+    cell_sharp = (edge_pixels == 0) | (sharpness_of(np.maximum(cell_ratio, 1.01)) >= min_cac_sharpness)
+    cell_sharp &= np.bincount(dot_cells, deep, rows * columns) >= np.bincount(dot_cells, minlength=rows * columns) / 2
+
+    flags = np.where(covered, np.where(cell_sharp, 0, 2), 1).astype(np.uint8).reshape(rows, columns)
+    return dots, float(covered.mean()), sharpness, flags
+
+
+# Why this isn't a usable CAC chart, or None if it is
+def cac_problem(dots, coverage, sharpness):
+    if dots < min_cac_dots:
+        return "No dot chart found"
+    elif coverage < min_cac_coverage:
+        return "The dots don't fill the frame"
+    elif sharpness < min_cac_sharpness:
+        return "The dots are out of focus"
+    return None
+
+
+# The CAC checks on a 2d image of levels in any units, scaled to 8 bits from the
+# black level up. Stretching the darkest levels to 0 instead would make blurred
+# dots look as dark in the middle as sharp ones.
+def cac_check(levels, black=0):
+    high = np.percentile(levels, 99)
+    grey = np.clip((levels - black) * (255 / max(high - black, 1e-9)), 0, 255).astype(np.uint8)
+    dots, coverage, sharpness, _ = find_dot_grid(grey)
+    return cac_problem(len(dots), coverage, sharpness)
+
+
+# The most memory quick_check_file(filename, step=step) holds at once, in
+# bytes, from the reader's own buffers: the mapped file, the quad means and one
+# chunk of decoded rows. 0 if the file can't be read.
+def quick_check_memory(filename, step=2):
+    try:
+        with DngRaw(filename) as raw:
+            quads = ((raw.height // 2 + step - 1) // step) * ((raw.width // 2 + step - 1) // step)
+            return len(raw.map) + quads * np.dtype(np.float32).itemsize + chunk_rows * raw.width * 2
+    except Exception:
+        return 0
+
+
+# Runs check(filename, ...) and returns its result with the most memory that
+# Python and numpy held at once while it ran, in bytes. It traces every
+# allocation in the process, so it is only for processes that do nothing but
+# checks, such as batch_tune.py's, and never for the app.
+def peak_memory(check, filename, *args):
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.start()
+    try:
+        result = check(filename, *args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return result, peak
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+# Runs a single ctt target (pisp or vc4) on a folder of captures in its own
+# process, so that TuningApp can run both targets side by side without
+# blocking the Qt thread.
+#
+# "prepare" instead reads the names of captures from stdin as they are taken,
+# and decodes and searches each one for the chart into the session cache. The
+# final run of each target then finds all of that work already done.
+#
+# Progress is written to stdout as one JSON object per line, e.g.
+#   {"target": "pisp", "stage": "alsc_cal", "step": 3, "steps": 10}
+# Everything ctt itself prints is sent to stderr instead.
+#
+# When several cameras are tuned at once their ctt runs take turns: no more
+# run at the same time than there are cores, whichever session they are from.
+# A target whose last run used exactly the captures there are now isn't run
+# again, see session_manifest.py.
+import argparse
+import contextlib
+import fcntl
+import functools
+import json
+import os
+import sys
+import time
+
+from session_cache import SessionCache, use_cache
+
+# finding ctt folder
+ctt_directory = os.path.join(os.path.expanduser("~"), 'libcamera/utils/raspberrypi/ctt')
+
+# tuning file written for each target
+json_outputs = {"pisp": "calibration_file_pi5.json", "vc4": "calibration_file_pi4.json"}
+
+# the real stdout, kept for progress messages while ctt output is redirected
+progress_out = sys.stdout
+
+# one lock file for each ctt run that may go at once on this machine
+slot_directory = os.path.join(os.path.expanduser("~"), ".cache", "camera-tuning-app", "ctt_slots")
+ctt_slots = os.cpu_count() or 1
+
+
+def emit(**message):
+    progress_out.write(json.dumps(message) + "\n")
+    progress_out.flush()
+
+
+# Wraps the Camera methods that make up the stages of run_ctt so that each one
+# reports itself as it starts. Returns the number of stages that can be reported.
+def hook_stages(Camera, target):
+    names = [name for name in vars(Camera) if name.endswith("_cal")] + ["add_imgs", "json_save"]
+    names = [name for name in names if callable(getattr(Camera, name, None))]
+    step = [0]
+
+    def wrap(name, method):
+        @functools.wraps(method)
+        def stage(*args, **kwargs):
+            step[0] += 1
+            emit(target=target, stage=name, step=step[0], steps=len(names))
+            return method(*args, **kwargs)
+        return stage
+
+    for name in names:
+        setattr(Camera, name, wrap(name, getattr(Camera, name)))
+    return len(names)
+
+
+# Waits for a free slot and holds it until the returned file is closed. The
+# lock goes with the process, so a worker that is killed frees its slot.
+def take_slot(target, steps, poll_seconds=0.5):
+    os.makedirs(slot_directory, exist_ok=True)
+    waiting = False
+    while True:
+        for slot in range(ctt_slots):
+            lock = open(os.path.join(slot_directory, "slot" + str(slot) + ".lock"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock
+            except BlockingIOError:
+                lock.close()
+        if not waiting:
+            waiting = True
+            emit(target=target, stage="waiting for a free core", step=0, steps=steps)
+        time.sleep(poll_seconds)
+
+
+def run_target(target, folder_directory, output_directory=None, cache=True):
+    import session_manifest
+    sys.path.insert(1, ctt_directory)
+    from ctt import Camera, run_ctt
+    if target == "pisp":
+        from ctt_pisp import grid_size, json_template
+    else:
+        from ctt_vc4 import grid_size, json_template
+
+    output_directory = output_directory or folder_directory
+    # decoded images and chart locations are shared with the other target and the checks
+    session_cache = SessionCache(output_directory) if cache else None
+    use_cache(session_cache)
+    steps = hook_stages(Camera, target)
+    emit(target=target, stage="start", step=0, steps=steps)
+    json_output = os.path.join(output_directory, json_outputs[target])
+    # each target gets its own log so that the two processes don't write over each other
+    log_output = os.path.join(output_directory, "ctt_" + target + ".log")
+    inputs = session_manifest.ctt_inputs(folder_directory)
+    if cache and session_manifest.ctt_up_to_date(folder_directory, target, inputs, json_output):
+        emit(target=target, stage="done", step=steps, steps=steps, output=json_output, skipped=True)
+        return
+    with take_slot(target, steps), contextlib.redirect_stdout(sys.stderr):
+        run_ctt(json_output, folder_directory, None, log_output, json_template, grid_size, target)
+    session_manifest.record_ctt(folder_directory, target, inputs, json_output)
+    emit(target=target, stage="done", step=steps, steps=steps, output=json_output,
+         cache_hits=session_cache.hits if cache else 0, cache_misses=session_cache.misses if cache else 0)
+
+
+def prepare_images(folder_directory):
+    sys.path.insert(1, ctt_directory)
+    from capture_checks import check_file
+    use_cache(SessionCache(folder_directory))
+    for line in sys.stdin:
+        filename = line.strip()
+        if not filename:
+            continue
+        start = time.monotonic()
+        with contextlib.redirect_stdout(sys.stderr):
+            try:
+                reason = check_file(filename)
+            except Exception as e:
+                reason = "failed: " + str(e)
+        emit(stage="prepared", file=filename, reason=reason, seconds=round(time.monotonic() - start, 3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one ctt target on a folder of tuning captures.")
+    parser.add_argument("target", choices=sorted(json_outputs) + ["prepare"])
+    parser.add_argument("folder", help="folder containing the captured DNG files")
+    parser.add_argument("--output-dir", help="where to write the tuning file, log and cache, the folder by default")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="decode every image again instead of using the cache, and run even if nothing has changed")
+    args = parser.parse_args()
+    if args.target == "prepare":
+        prepare_images(args.folder)
+    else:
+        run_target(args.target, args.folder, args.output_dir, not args.no_cache)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# Reads the raw image of a DNG for validation, without ctt.
+#
+# The file is memory mapped and only the rows that are asked for are decoded,
+# so checking a capture never needs the whole image in memory at once, let
+# alone the several full size copies that dng_load_image and check_file make.
+# Only uncompressed raw data is supported, laid out the way PiDNG writes it:
+# one strip or tile holding the whole image, 8 or 16 bit samples or MSB first
+# packed 10, 12 and 14 bit ones.
+import mmap
+import struct
+
+import numpy as np
+
+# TIFF tags used here
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC_INTERPRETATION = 262
+STRIP_OFFSETS = 273
+STRIP_BYTE_COUNTS = 279
+TILE_WIDTH = 322
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SUB_IFDS = 330
+BLACK_LEVEL = 50714
+WHITE_LEVEL = 50717
+CFA = 32803
+
+# numpy type of each TIFF field type, rationals are pairs
+field_types = {1: "u1", 2: "u1", 3: "u2", 4: "u4", 5: "u4", 6: "i1", 7: "u1", 8: "i2", 9: "i4", 10: "i4", 11: "f4",
+               12: "f8", 13: "u4", 16: "u8", 17: "i8", 18: "u8"}
+
+# rows decoded at a time, so the working memory doesn't grow with the image
+chunk_rows = 64
+
+
+class DngRaw:
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+        try:
+            self.parse()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # the mapping can't be closed while an array still looks at it
+        self.data = None
+        self.map.close()
+        self.file.close()
+
+    def parse(self):
+        order = self.map[:2]
+        if order not in (b"II", b"MM"):
+            raise ValueError("not a TIFF/DNG file")
+        self.order = "<" if order == b"II" else ">"
+        if struct.unpack(self.order + "H", self.map[2:4])[0] != 42:
+            raise ValueError("not a TIFF/DNG file")
+        ifds = self.read_ifds(struct.unpack(self.order + "I", self.map[4:8])[0])
+        raw = [ifd for ifd in ifds if self.value(ifd, NEW_SUBFILE_TYPE, 0) == 0]
+        raw = [ifd for ifd in raw if self.value(ifd, PHOTOMETRIC_INTERPRETATION, CFA) == CFA]
+        if not raw:
+            raise ValueError("no raw image found")
+        ifd = max(raw, key=lambda ifd: self.value(ifd, IMAGE_WIDTH, 0) * self.value(ifd, IMAGE_LENGTH, 0))
+
+        if self.value(ifd, COMPRESSION, 1) != 1:
+            raise ValueError("compressed raw data is not supported")
+        self.width = int(self.value(ifd, IMAGE_WIDTH))
+        self.height = int(self.value(ifd, IMAGE_LENGTH))
+        self.bit_depth = int(self.value(ifd, BITS_PER_SAMPLE))
+        if self.bit_depth not in (8, 10, 12, 14, 16):
+            raise ValueError("unsupported bit depth " + str(self.bit_depth))
+        self.black_level = float(np.mean(self.values(ifd, BLACK_LEVEL, [0])))
+        self.white_level = float(np.max(self.values(ifd, WHITE_LEVEL, [2 ** self.bit_depth - 1])))
+
+        if TILE_OFFSETS in ifd:
+            if self.value(ifd, TILE_WIDTH, self.width) < self.width:
+                raise ValueError("tiles narrower than the image are not supported")
+            offsets, counts = self.values(ifd, TILE_OFFSETS), self.values(ifd, TILE_BYTE_COUNTS)
+        else:
+            offsets, counts = self.values(ifd, STRIP_OFFSETS), self.values(ifd, STRIP_BYTE_COUNTS)
+        # strips or tiles of whole rows are fine as long as they follow on from each other
+        if np.any(offsets[1:] != offsets[:-1] + counts[:-1]):
+            raise ValueError("raw data is not contiguous")
+        self.row_bytes = (self.width * self.bit_depth + 7) // 8
+        if int(counts.sum()) < self.row_bytes * self.height or int(offsets[0]) + self.row_bytes * self.height > len(self.map):
+            raise ValueError("raw data is truncated")
+        self.data = np.frombuffer(self.map, np.uint8, self.row_bytes * self.height, int(offsets[0]))
+        self.data = self.data.reshape(self.height, self.row_bytes)
+
+    # IFD0 and anything reached from it, each as {tag: (type, count, offset of the value)}
+    def read_ifds(self, offset):
+        ifds = []
+        pending = [offset]
+        seen = set()
+        while pending:
+            offset = pending.pop(0)
+            if offset == 0 or offset in seen or offset + 2 > len(self.map):
+                continue
+            seen.add(offset)
+            count = struct.unpack_from(self.order + "H", self.map, offset)[0]
+            ifd = {}
+            for i in range(count):
+                tag, kind, n, value = struct.unpack_from(self.order + "HHII", self.map, offset + 2 + 12 * i)
+                size = np.dtype(field_types.get(kind, "u1")).itemsize * n * (2 if kind in (5, 10) else 1)
+                # values of up to four bytes are held in the entry itself
+                ifd[tag] = (kind, n, offset + 10 + 12 * i if size <= 4 else value)
+            ifds.append(ifd)
+            pending.append(struct.unpack_from(self.order + "I", self.map, offset + 2 + 12 * count)[0])
+            if SUB_IFDS in ifd:
+                pending.extend(int(v) for v in self.values(ifd, SUB_IFDS))
+        return ifds
+
+    def values(self, ifd, tag, default=None):
+        if tag not in ifd:
+            return np.array(default)
+        kind, n, offset = ifd[tag]
+        if kind not in field_types:
+            raise ValueError("unsupported type for tag " + str(tag))
+        dtype = np.dtype(field_types[kind]).newbyteorder(self.order)
+        if kind in (5, 10):
+            pairs = np.frombuffer(self.map, dtype, 2 * n, offset).reshape(n, 2).astype(np.float64)
+            return pairs[:, 0] / pairs[:, 1]
+        return np.frombuffer(self.map, dtype, n, offset).copy()
+
+    def value(self, ifd, tag, default=None):
+        return self.values(ifd, tag, [default])[0]
+
+    # The given rows of packed bytes as uint16 samples
+    def decode(self, rows):
+        n = rows.shape[0]
+        if self.bit_depth == 8:
+            return rows.astype(np.uint16)
+        elif self.bit_depth == 16:
+            return rows.view(np.dtype(np.uint16).newbyteorder(self.order)).astype(np.uint16)
+        elif self.bit_depth == 10 and self.width % 4 == 0:
+            b = rows.reshape(n, -1, 5).astype(np.uint16)
+            pixels = np.stack((b[:, :, 0] << 2 | b[:, :, 1] >> 6, (b[:, :, 1] & 0x3f) << 4 | b[:, :, 2] >> 4,
+                               (b[:, :, 2] & 0xf) << 6 | b[:, :, 3] >> 2, (b[:, :, 3] & 0x3) << 8 | b[:, :, 4]), axis=-1)
+            return pixels.reshape(n, -1)
+        elif self.bit_depth == 12 and self.width % 2 == 0:
+            b = rows.reshape(n, -1, 3).astype(np.uint16)
+            pixels = np.stack((b[:, :, 0] << 4 | b[:, :, 1] >> 4, (b[:, :, 1] & 0xf) << 8 | b[:, :, 2]), axis=-1)
+            return pixels.reshape(n, -1)
+        # anything else is taken bit by bit
+        bits = np.unpackbits(rows, axis=1)[:, :self.width * self.bit_depth].reshape(n, self.width, self.bit_depth)
+        weights = (1 << np.arange(self.bit_depth - 1, -1, -1)).astype(np.uint16)
+        return (bits * weights).sum(axis=2, dtype=np.uint16)
+
+    # The mean of every step-th 2x2 Bayer quad in each direction, in raw
+    # units. At step 1 this is the image ctt's check averages the channels into.
+    def quad_means(self, step=1):
+        quad_rows = np.arange(0, self.height // 2, step)
+        quad_columns = (self.width // 2 + step - 1) // step
+        means = np.empty((len(quad_rows), quad_columns), dtype=np.float32)
+        for start in range(0, len(quad_rows), chunk_rows // 2):
+            block = quad_rows[start:start + chunk_rows // 2]
+            rows = np.stack((2 * block, 2 * block + 1), axis=1).reshape(-1)
+            image = self.decode(self.data[rows])[:, :self.width // 2 * 2]
+            quads = image.reshape(len(block), 2, -1, 2)[:, :, ::step, :]
+            means[start:start + len(block)] = quads.sum(axis=(1, 3), dtype=np.uint32) * 0.25
+        return means
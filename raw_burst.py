@@ -0,0 +1,18 @@
+# The sum of a burst of raw frames, as the app averages its stills. The app's
+# RawBurst and the replay camera's ReplayBurst both build on it, so the bench
+# runs the same averaging as the app.
+import numpy as np
+
+
+class BurstSum:
+    def __init__(self):
+        # the uint32 sum of the unpacked frames, how many there were and their bit depth
+        self.total = None
+        self.count = 0
+        self.bit_depth = None
+
+    # the rounded mean, in the type the unpacked frames had
+    def average(self):
+        average = self.total + self.count // 2
+        average //= self.count
+        return average.astype(np.uint8 if self.bit_depth == 8 else np.uint16)
@@ -0,0 +1,277 @@
+# A stand-in for Picamera2 that replays a folder instead of using a camera, so
+# that the whole app can run, and be timed, on any Linux machine:
+#
+#   TUNING_REPLAY=~/imx708_1 QT_QPA_PLATFORM=offscreen ./TuningApp.py
+#
+# The folder is usually an earlier tuning session. Its DNGs are handed back as
+# the stills, in order for each kind of capture, and a preview/ folder of 8 bit
+# greyscale frames (.png, .pgm, .jpg or .npy) is played at a fixed frame rate.
+# Without one the preview shows each still in turn for a couple of seconds. An
+# optional replay.json there sets the camera model, the ctt target and timings:
+#   {"model": "imx708", "target": "pi5", "fps": 30, "still_fps": 10, "switch_seconds": 0.1}
+import json
+import os
+import shutil
+import threading
+import time
+
+import cv2
+import numpy as np
+from PyQt5.QtCore import QRectF, Qt, pyqtSignal
+from PyQt5.QtGui import QColor, QImage, QPainter
+from PyQt5.QtWidgets import QWidget
+
+from capture_checks import capture_kind
+from dng_reader import DngRaw
+from raw_burst import BurstSum
+
+defaults = {"model": "replay", "target": "pi5", "fps": 30, "still_fps": 10, "switch_seconds": 0.1}
+# how long the preview shows each still when there are no recorded frames
+seconds_per_still = 2
+# the recorded frames are read into memory, up to this many
+max_preview_frames = 1000
+
+
+# The result of a capture, handed to the signal function as picamera2's jobs are
+class ReplayJob:
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+
+    def get_result(self, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+# A stored DNG in place of a burst of raw frames. Every frame of the burst would
+# be the same, so the sum is just the image times the number of frames.
+class ReplayBurst(BurstSum):
+    def __init__(self, filename, frames):
+        super().__init__()
+        self.source = filename
+        with DngRaw(filename) as raw:
+            image = raw.decode(raw.data)
+            self.bit_depth = raw.bit_depth
+            # picamera2 gives black levels in 16 bit units
+            black = raw.black_level * 2 ** (16 - raw.bit_depth)
+        self.count = frames
+        self.total = image.astype(np.uint32) * frames
+        self.metadata = {"SensorBlackLevels": [black] * 4}
+        self.config = {"size": (image.shape[1], image.shape[0])}
+
+    # the still is the stored file, unchanged
+    def save_dng(self, filename):
+        shutil.copyfile(self.source, filename)
+
+
+# The preview frames recorded in folder, or None if there aren't any
+def recorded_frames(folder):
+    if not os.path.isdir(folder):
+        return None
+    frames = []
+    for name in sorted(os.listdir(folder))[:max_preview_frames]:
+        path = os.path.join(folder, name)
+        if name.endswith(".npy"):
+            frames.append(np.load(path))
+        elif name.endswith((".png", ".pgm", ".jpg")):
+            frames.append(cv2.imread(path, flags=cv2.IMREAD_GRAYSCALE))
+    return [np.ascontiguousarray(frame, dtype=np.uint8) for frame in frames if frame is not None] or None
+
+
+# A small, gamma corrected greyscale picture of a still, from its Bayer quads
+def still_preview(filename):
+    with DngRaw(filename) as raw:
+        levels = raw.quad_means(max(1, raw.width // 1600))
+        levels = (levels - raw.black_level) / max(raw.white_level - raw.black_level, 1)
+    return np.round(255 * np.clip(levels, 0, 1) ** (1 / 2.2)).astype(np.uint8)
+
+
+class ReplayCamera:
+    def __init__(self, folder):
+        self.folder = folder
+        settings = dict(defaults)
+        settings_file = os.path.join(folder, "replay.json")
+        if os.path.exists(settings_file):
+            with open(settings_file) as f:
+                settings.update(json.load(f))
+        self.model = settings["model"]
+        self.target = settings["target"]
+        self.fps = settings["fps"]
+        self.still_fps = settings["still_fps"]
+        self.switch_seconds = settings["switch_seconds"]
+
+        # the stored stills of each kind, and how many of each have been handed out
+        self.stills = {}
+        for name in sorted(os.listdir(folder)):
+            kind = capture_kind(name)
+            if kind is not None:
+                self.stills.setdefault(kind, []).append(os.path.join(folder, name))
+        self.stills_taken = {}
+        self.frames = recorded_frames(os.path.join(folder, "preview"))
+        if self.frames is None:
+            stills = [still_preview(f) for kind in ("macbeth", "alsc", "cac") for f in self.stills.get(kind, [])]
+            if not stills:
+                raise ValueError("nothing to replay in " + folder)
+            repeat = max(1, int(seconds_per_still * self.fps))
+            self.frames = [frame for frame in stills for _ in range(repeat)]
+
+        self.camera_config = None
+        self.preview = None
+        self.frame_number = 0
+        # capture_array and burst requests waiting for the camera thread
+        self.requests = []
+        self.bursts = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+    def create_preview_configuration(self, main=None, lores=None, sensor=None):
+        return {"main": dict(main or {"size": (640, 480)}), "lores": dict(lores) if lores else None}
+
+    def create_still_configuration(self):
+        return {"main": {"size": self.frames[0].shape[::-1]}, "lores": None}
+
+    def configure(self, config):
+        self.camera_config = config
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name="replay camera", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    # the preview widget is sent every frame, as QGlPicamera2 is
+    def attach_preview(self, preview):
+        self.preview = preview
+
+    # The stream's array from the next frame. With a signal function it returns
+    # at once and the job is passed to it, otherwise it waits for the array.
+    def capture_array(self, name="main", signal_function=None):
+        if signal_function is not None:
+            with self.lock:
+                self.requests.append((name, signal_function))
+            return None
+        done = threading.Event()
+        jobs = []
+        with self.lock:
+            self.requests.append((name, lambda job: (jobs.append(job), done.set())))
+        done.wait()
+        return jobs[0].get_result()
+
+    # Takes the next stored still of this kind, after as long as switching mode
+    # and taking that many frames would
+    def capture_burst(self, kind, frames, signal_function):
+        with self.lock:
+            self.bursts.append((kind, frames, signal_function))
+
+    # the camera thread, one frame each 1 / fps seconds
+    def run(self):
+        next_time = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.running:
+                    return
+                burst = self.bursts.pop(0) if self.bursts else None
+            if burst is not None:
+                self.take_burst(*burst)
+                next_time = time.monotonic()
+                continue
+            time.sleep(max(0.0, next_time - time.monotonic()))
+            # a late frame doesn't make the next ones come any sooner
+            next_time = max(next_time + 1 / self.fps, time.monotonic())
+            self.deliver_frame()
+
+    def deliver_frame(self):
+        grey = self.frames[self.frame_number % len(self.frames)]
+        self.frame_number += 1
+        arrays = {}
+        for name in ("main", "lores"):
+            stream = self.camera_config.get(name)
+            if stream is None:
+                continue
+            w, h = stream["size"]
+            y = grey if grey.shape == (h, w) else cv2.resize(grey, (w, h), interpolation=cv2.INTER_AREA)
+            if stream.get("format") == "YUV420":
+                # the Y plane with grey chroma below it, as the camera lays it out
+                array = np.full((h * 3 // 2, w), 128, dtype=np.uint8)
+                array[:h] = y
+            else:
+                array = np.empty((h, w, 4), dtype=np.uint8)
+                array[:, :, :3] = y[:, :, None]
+                array[:, :, 3] = 255
+            arrays[name] = array
+        if self.preview is not None:
+            self.preview.frame_signal.emit(arrays["main"])
+        with self.lock:
+            requests, self.requests = self.requests, []
+        for name, signal_function in requests:
+            signal_function(ReplayJob(arrays[name].copy()))
+
+    def take_burst(self, kind, frames, signal_function):
+        time.sleep(self.switch_seconds + frames / self.still_fps)
+        try:
+            stills = self.stills.get(kind)
+            if not stills:
+                raise RuntimeError("no " + kind + " DNGs to replay in " + self.folder)
+            taken = self.stills_taken.get(kind, 0)
+            self.stills_taken[kind] = taken + 1
+            job = ReplayJob(ReplayBurst(stills[taken % len(stills)], frames))
+        except Exception as e:
+            job = ReplayJob(error=e)
+        signal_function(job)
+
+
+# Shows the replayed frames with the overlay on top, in place of QGlPicamera2
+class ReplayPreview(QWidget):
+    done_signal = pyqtSignal(object)
+    frame_signal = pyqtSignal(object)
+
+    def __init__(self, picam2, parent=None, width=640, height=480, keep_ar=True, bg_colour=(20, 20, 20)):
+        super().__init__(parent)
+        self.keep_ar = keep_ar
+        self.bg_colour = QColor(*bg_colour)
+        self.resize(width, height)
+        self.image = None
+        self.overlay = None
+        self.frame_signal.connect(self.show_frame)
+        picam2.attach_preview(self)
+
+    def signal_done(self, job):
+        self.done_signal.emit(job)
+
+    def show_frame(self, array):
+        h, w = array.shape[:2]
+        self.image = QImage(array.data, w, h, array.strides[0], QImage.Format_RGBX8888).copy()
+        self.update()
+
+    # RGBA, copied as QGlPicamera2 does so the caller can reuse its array
+    def set_overlay(self, overlay):
+        if overlay is None:
+            self.overlay = None
+        else:
+            overlay = np.ascontiguousarray(overlay)
+            h, w = overlay.shape[:2]
+            self.overlay = QImage(overlay.data, w, h, overlay.strides[0], QImage.Format_RGBA8888).copy()
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.bg_colour)
+        if self.image is None:
+            return
+        size = self.image.size().scaled(self.size(), Qt.KeepAspectRatio if self.keep_ar else Qt.IgnoreAspectRatio)
+        target = QRectF((self.width() - size.width()) / 2, (self.height() - size.height()) / 2,
+                        size.width(), size.height())
+        painter.drawImage(target, self.image)
+        if self.overlay is not None:
+            painter.drawImage(target, self.overlay)
@@ -0,0 +1,170 @@
+# Decode and chart-location cache for a session folder.
+#
+# Both ctt targets decode every DNG and search each macbeth image for the
+# chart, and check() does the same again. use_cache() wraps ctt's
+# dng_load_image and find_macbeth so that each of these is worked out once.
+# The results are pickled into <folder>/.cache, keyed by a hash of the DNG's
+# contents or of the image searched, so every process working on the folder
+# shares them. When two processes want the same entry, one works it out and
+# the other waits for it.
+import fcntl
+import hashlib
+import os
+import pickle
+import sys
+
+import numpy as np
+
+cache_dirname = ".cache"
+# the least recently used entries are removed once the cache is bigger than this
+max_cache_bytes = 1024 ** 3
+
+
+def file_hash(filename):
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def array_hash(array, *extra):
+    array = np.ascontiguousarray(array)
+    h = hashlib.blake2b(repr((array.dtype.str, array.shape, extra)).encode(), digest_size=16)
+    h.update(array)
+    return h.hexdigest()
+
+
+class SessionCache:
+    def __init__(self, folder, max_bytes=max_cache_bytes):
+        self.directory = os.path.join(folder, cache_dirname)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    # Returns the value stored under key, working it out with compute() first
+    # if it isn't there yet
+    def get(self, key, compute):
+        path = os.path.join(self.directory, key + ".pkl")
+        entry = self.load(path)
+        if entry is None:
+            with open(path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # someone else may have worked it out while we waited
+                entry = self.load(path)
+                if entry is None:
+                    self.misses += 1
+                    entry = (compute(),)
+                    self.store(path, entry)
+                    return entry[0]
+        self.hits += 1
+        return entry[0]
+
+    def load(self, path):
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+            # marks it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # a damaged entry is worked out again
+            return None
+        return entry
+
+    def store(self, path, entry):
+        tmp = path + "." + str(os.getpid()) + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except Exception:
+            # not everything ctt makes can be pickled, it just isn't cached
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pkl"):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in (os.path.join(self.directory, name), os.path.join(self.directory, name + ".lock")):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
+# ctt keeps the Bayer channels as wide integers. They are stored as 16 bits,
+# which is all they hold, and widened again when loaded.
+class PackedImage:
+    def __init__(self, Img):
+        self.attributes = dict(vars(Img))
+        self.cls = type(Img)
+        self.channels = None
+        channels = np.array(Img.channels)
+        if channels.dtype.kind in "iu" and channels.min() >= 0 and channels.max() < 2**16:
+            self.attributes.pop("channels")
+            self.channels = channels.astype(np.uint16)
+            self.dtype = channels.dtype
+            self.as_list = isinstance(Img.channels, list)
+
+    def unpack(self):
+        Img = self.cls.__new__(self.cls)
+        vars(Img).update(self.attributes)
+        if self.channels is not None:
+            channels = self.channels.astype(self.dtype)
+            Img.channels = list(channels) if self.as_list else channels
+        return Img
+
+
+active_cache = None
+originals = {}
+
+
+def cached_dng_load_image(Cam, im_str, *args, **kwargs):
+    dng_load_image = originals["dng_load_image"]
+    if active_cache is None:
+        return dng_load_image(Cam, im_str, *args, **kwargs)
+    key = "dng_" + file_hash(im_str)
+    packed = active_cache.get(key, lambda: PackedImage(dng_load_image(Cam, im_str, *args, **kwargs)))
+    return packed.unpack()
+
+
+def cached_find_macbeth(Cam, img, mac_config=(0, 0)):
+    find_macbeth = originals["find_macbeth"]
+    if active_cache is None:
+        return find_macbeth(Cam, img, mac_config)
+    key = "macbeth_" + array_hash(img, tuple(mac_config) if mac_config is not None else None)
+    return active_cache.get(key, lambda: find_macbeth(Cam, img, mac_config))
+
+
+# Makes ctt, and anything that has imported these functions from it, go through
+# the cache. Passing None turns the cache off again.
+def use_cache(cache):
+    global active_cache
+    active_cache = cache
+    if originals:
+        return
+    import ctt_image_load
+    import ctt_macbeth_locator
+    originals["dng_load_image"] = ctt_image_load.dng_load_image
+    originals["find_macbeth"] = ctt_macbeth_locator.find_macbeth
+    wrappers = {"dng_load_image": cached_dng_load_image, "find_macbeth": cached_find_macbeth}
+    for module in list(sys.modules.values()):
+        for name, original in originals.items():
+            if getattr(module, name, None) is original:
+                setattr(module, name, wrappers[name])
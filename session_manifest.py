@@ -0,0 +1,186 @@
+# The record of a tuning session, kept in <folder>/manifest.json so that a
+# session can be reopened and carried on after the app has been closed or has
+# crashed.
+#
+# It holds the camera the session was started with and, for each capture, what
+# it is, when it was taken, a hash of its contents and what the checks made of
+# it. For each ctt target it also holds the hashes of the captures its last run
+# used, so that a run on the same captures again can be skipped. The app and
+# the ctt workers all write to it, so every change is a locked read, modify and
+# write.
+import contextlib
+import fcntl
+import json
+import os
+import re
+import time
+
+from capture_checks import capture_kind
+from session_cache import file_hash
+
+manifest_name = "manifest.json"
+# where captures that fail their checks are moved, out of ctt's way
+rejected_name = "rejected"
+version = 1
+
+# temperature, lux or index from the name of each kind of capture
+capture_names = {
+    "macbeth": re.compile(r"(?P<temperature>\d+)[kK]_(?P<lux>\d+)[lL]\.dng$"),
+    "alsc": re.compile(r"alsc_(?P<temperature>\d+)[kK]_(?P<index>\d+)\.dng$"),
+    "cac": re.compile(r"cac_chart(?P<index>\d+)\.dng$"),
+}
+
+
+def manifest_path(folder):
+    return os.path.join(folder, manifest_name)
+
+
+# A folder with a manifest, or with captures from before there was one
+def is_session(folder):
+    if not os.path.isdir(folder):
+        return False
+    return os.path.isfile(manifest_path(folder)) or any(capture_kind(name) for name in os.listdir(folder))
+
+
+def load(folder):
+    try:
+        with open(manifest_path(folder)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        # a missing or damaged manifest is made again from the files in the folder
+        manifest = {}
+    manifest.setdefault("version", version)
+    manifest.setdefault("camera", {})
+    manifest.setdefault("captures", {})
+    manifest.setdefault("ctt", {})
+    return manifest
+
+
+def save(folder, manifest):
+    path = manifest_path(folder)
+    tmp = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# The manifest to change in the body of a with statement, saved at the end of it
+@contextlib.contextmanager
+def update(folder):
+    with open(manifest_path(folder) + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = load(folder)
+        yield manifest
+        save(folder, manifest)
+
+
+# What a capture is, from its file name
+def capture_info(name):
+    kind = capture_kind(name)
+    info = {"kind": kind}
+    match = capture_names[kind].search(os.path.basename(name)) if kind else None
+    if match:
+        info.update({key: int(value) if key == "index" else value for key, value in match.groupdict().items()})
+    return info
+
+
+def file_stat(filename):
+    st = os.stat(filename)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+# Starts a new session, or checks that an old one is being carried on with the
+# same kind of camera. Returns the model the session was started with.
+def start(folder, model, target):
+    with update(folder) as manifest:
+        camera = manifest["camera"]
+        if not camera:
+            camera.update(model=model, target=target, started=time.time())
+        return camera["model"]
+
+
+# Records a capture once it is safely written, with the result of the check it passed
+def record_capture(filename, check):
+    entry = dict(capture_info(filename), hash=file_hash(filename), taken=time.time(), check=check, analysis=None)
+    entry.update(file_stat(filename))
+    with update(os.path.dirname(filename)) as manifest:
+        manifest["captures"][os.path.basename(filename)] = entry
+
+
+# Records what a check of a capture already on disk made of it, None if it passed
+def record_check(filename, reason):
+    with update(os.path.dirname(filename)) as manifest:
+        entry = manifest["captures"].get(os.path.basename(filename))
+        if entry is not None:
+            entry["check"] = reason or "passed"
+
+
+# Moves a capture that failed its check into the rejected folder, where neither
+# ctt nor the manifest look, and forgets it
+def reject(filename):
+    folder = os.path.dirname(filename)
+    os.makedirs(os.path.join(folder, rejected_name), exist_ok=True)
+    os.replace(filename, os.path.join(folder, rejected_name, os.path.basename(filename)))
+    with update(folder) as manifest:
+        manifest["captures"].pop(os.path.basename(filename), None)
+
+
+# Records what the background analysis for ctt made of a capture, None if it is fine
+def record_analysis(filename, reason):
+    with update(os.path.dirname(filename)) as manifest:
+        entry = manifest["captures"].get(os.path.basename(filename))
+        if entry is not None:
+            entry["analysis"] = reason or "passed"
+
+
+def same_file(entry, stat):
+    return entry is not None and all(entry.get(key) == value for key, value in stat.items())
+
+
+# The captures in the folder, oldest first, as {name: entry}. Entries for files
+# that have gone are dropped, files that aren't in the manifest yet are added,
+# and files that have changed since they were recorded are hashed again and
+# lose their analysis. The hashing is done before the manifest is locked, so
+# that a folder of new files doesn't hold up everything else that records in it.
+def captures(folder):
+    names = [name for name in os.listdir(folder) if capture_kind(name) is not None]
+    recorded = load(folder)["captures"]
+    changed = {}
+    for name in names:
+        filename = os.path.join(folder, name)
+        stat = file_stat(filename)
+        if not same_file(recorded.get(name), stat):
+            changed[name] = (stat, file_hash(filename))
+    with update(folder) as manifest:
+        recorded = manifest["captures"]
+        for name in list(recorded):
+            if name not in names:
+                del recorded[name]
+        for name, (stat, digest) in changed.items():
+            entry = recorded.get(name)
+            # recorded by the app while it was being hashed
+            if same_file(entry, stat):
+                continue
+            entry = dict(capture_info(name), hash=digest, check=None, analysis=None,
+                         taken=entry["taken"] if entry else stat["mtime_ns"] / 1e9)
+            entry.update(stat)
+            recorded[name] = entry
+        return dict(sorted(recorded.items(), key=lambda item: (item[1]["taken"], item[0])))
+
+
+# The hashes of the captures a ctt run would use now
+def ctt_inputs(folder):
+    return {name: entry["hash"] for name, entry in captures(folder).items()}
+
+
+# Whether the target's last run used exactly these captures and its tuning file is still there
+def ctt_up_to_date(folder, target, inputs, output):
+    last = load(folder)["ctt"].get(target)
+    return last is not None and last["inputs"] == inputs and last["output"] == output and os.path.exists(output)
+
+
+def record_ctt(folder, target, inputs, output):
+    with update(folder) as manifest:
+        manifest["ctt"][target] = {"inputs": inputs, "output": output, "finished": time.time()}
@@ -0,0 +1,106 @@
+# Records how long each stage of a tuning session takes, as a timeline that
+# chrome://tracing or https://ui.perfetto.dev can open.
+#
+# Recording is off unless TUNING_TRACE is set in the environment. While it is
+# off span() hands back the same do-nothing context manager and now() returns
+# None, so the calls can stay in the hot paths.
+#
+#   with timeline.span("find macbeth", gains=3):
+#       ...
+#   start = timeline.now()
+#   ...
+#   timeline.record("preview frame", start)
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+enabled = bool(os.environ.get("TUNING_TRACE"))
+# the oldest events are dropped after this many, about an hour of preview
+max_events = 500000
+
+events = deque(maxlen=max_events)
+thread_names = {}
+output_directory = None
+
+
+def now():
+    return time.perf_counter() if enabled else None
+
+
+# A finished span from start, a now() value, to now. Spans that overlap without
+# nesting, such as the two ctt targets, are given a thread of their own to be
+# drawn on.
+def record(name, start, thread=None, **args):
+    if start is None or not enabled:
+        return
+    end = time.perf_counter()
+    tid = threading.get_ident() if thread is None else abs(hash(thread)) % 2**31
+    if tid not in thread_names:
+        thread_names[tid] = threading.current_thread().name if thread is None else thread
+    events.append({"name": name, "ph": "X", "ts": start * 1e6, "dur": (end - start) * 1e6, "pid": os.getpid(),
+                   "tid": tid, "args": args})
+
+
+class Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.args
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, **self.args)
+
+
+# Times the body of a with statement. Arguments worked out inside it can be
+# added to the dictionary it gives back.
+def span(name, **args):
+    if not enabled:
+        # a dictionary of its own, thrown away with anything added to it
+        return contextlib.nullcontext({})
+    return Span(name, args)
+
+
+# Values that change over time, such as the preview frame rate, drawn as a graph
+def counter(name, **values):
+    if enabled:
+        events.append({"name": name, "ph": "C", "ts": time.perf_counter() * 1e6, "pid": os.getpid(), "args": values})
+
+
+# Chooses the session folder the timeline is written to when the app exits
+def start(folder):
+    global output_directory
+    if enabled and output_directory is None:
+        atexit.register(save)
+    output_directory = folder
+
+
+# Writes trace.json, and a summary of each stage to log.txt, in the session folder
+def save():
+    if not enabled or output_directory is None:
+        return
+    recorded = list(events)
+    names = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+             for tid, name in list(thread_names.items())]
+    path = os.path.join(output_directory, "trace.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump({"traceEvents": names + recorded, "displayTimeUnit": "ms"}, f)
+    os.replace(path + ".tmp", path)
+
+    durations = {}
+    for event in recorded:
+        if event["ph"] == "X":
+            durations.setdefault(event["name"], []).append(event["dur"] / 1000)
+    with open(os.path.join(output_directory, "log.txt"), "w") as f:
+        f.write("%-24s %8s %10s %10s %10s %12s\n" % ("stage", "count", "mean ms", "p95 ms", "max ms", "total s"))
+        for name, times in sorted(durations.items(), key=lambda item: -sum(item[1])):
+            times.sort()
+            f.write("%-24s %8d %10.2f %10.2f %10.2f %12.2f\n" % (
+                name, len(times), sum(times) / len(times), times[int(0.95 * (len(times) - 1))], times[-1],
+                sum(times) / 1000))